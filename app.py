@@ -1,8 +1,13 @@
 # app.py – Complete Image tools for Government Job Applications
-import os, io, tempfile, uuid, traceback
-from flask import Flask, render_template_string, request, send_file
+import os, io, tempfile, uuid, traceback, hashlib, threading, json, zipfile, shutil, subprocess, functools, gzip
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+from flask import Flask, Request, Response, jsonify, request, send_file, url_for
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
-from PIL import Image, ImageOps
+from PIL import Image, ImageChops, ImageOps, ImageEnhance, ImageFilter, ExifTags
 import time
 
 app = Flask(__name__)
@@ -14,32 +19,1784 @@ ALLOWED_EXT = {'png','jpg','jpeg','webp','bmp','gif'}
 def allowed_filename(filename):
     return '.' in filename and filename.rsplit('.',1)[1].lower() in ALLOWED_EXT
 
-def pil_open_validate(file_stream):
+# Cap on decoded pixels per route, checked from the header before decoding.
+# MAX_MEGAPIXELS sets it for every route and MAX_MEGAPIXELS_<ROUTE> (e.g.
+# MAX_MEGAPIXELS_TO_PDF) for one; the default covers 108 MP phone sensors.
+MAX_MEGAPIXELS = float(os.environ.get('MAX_MEGAPIXELS', 110))
+MAX_PIXELS = {route: int(float(os.environ.get(f'MAX_MEGAPIXELS_{route.upper()}', MAX_MEGAPIXELS)) * 1_000_000)
+              for route in ('passport', 'compress', 'to_pdf', 'signature', 'crop', 'rotate', 'filter')}
+# Pillow's own decompression bomb limit follows the largest cap
+Image.MAX_IMAGE_PIXELS = max(MAX_PIXELS.values())
+
+# Result buffers above this size spill from memory to an anonymous temp file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+def spooled_buffer():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+def send_buffer(buf, download_name):
+    # Werkzeug closes buf once the response is sent, which also removes a spilled file
+    with timed('send'):
+        count('bytes_out', buf.seek(0, os.SEEK_END))
+        buf.seek(0)
+        return send_file(buf, as_attachment=True, download_name=download_name)
+
+# Uploads are checked while the multipart body streams in: each image part's
+# magic bytes and header (format, dimensions) are read from its first chunks.
+# On single-image routes a bad file or one over the route's pixel cap fails
+# the request before the rest of the body is read; on multi-file routes the
+# part is marked rejected and the rest of it dropped, so the view can skip it
+# or report it. Parts over UPLOAD_SPOOL_SIZE spool to disk.
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+UPLOAD_SNIFF_LIMIT = 256 * 1024   # give up looking for a header after this much
+UPLOAD_MAGIC = ((b'\xff\xd8\xff', 'JPEG'), (b'\x89PNG\r\n\x1a\n', 'PNG'), (b'GIF87a', 'GIF'), (b'GIF89a', 'GIF'),
+                (b'BM', 'BMP'), (b'RIFF', 'WEBP'))
+MULTI_FILE_ROUTES = {'to_pdf', 'batch'}
+
+class UploadRejected(HTTPException):
+    def __init__(self, code, description):
+        super().__init__(description)
+        self.code = code
+
+def sniff_format(head):
+    for magic, fmt in UPLOAD_MAGIC:
+        if head.startswith(magic) and (fmt != 'WEBP' or head[8:12] == b'WEBP'):
+            return fmt
+
+class UploadSpool(tempfile.SpooledTemporaryFile):
+    def __init__(self, filename, max_pixels, multi=False):
+        super().__init__(max_size=UPLOAD_SPOOL_SIZE)
+        self.filename, self.max_pixels, self.multi = filename, max_pixels, multi
+        self.head = b''   # None once the header is checked or given up on
+        self.format = self.size = self.pixels = None
+        self.rejected = None   # the reason, once a multi-file part is rejected
+        self.complete = False
+
+    def write(self, data):
+        if self.head is not None:
+            self.head += data
+            self.check_header(io.BytesIO(self.head), False)
+            if self.head is not None and len(self.head) >= UPLOAD_SNIFF_LIMIT:
+                self.head = None
+        if self.rejected:
+            return len(data)
+        return super().write(data)
+
+    def seek(self, *args):
+        # The parser rewinds each part once all of it is in. A part whose
+        # header was never read, too short or past UPLOAD_SNIFF_LIMIT, is
+        # checked whole then, and rejected if it still has none
+        if not self.complete and self.pixels is None and not self.rejected:
+            self.complete = True
+            super().seek(0)
+            self.check_header(self, True)
+        return super().seek(*args)
+
+    def reject(self, code, description):
+        count('uploads_rejected')
+        if not self.multi:
+            raise UploadRejected(code, description)
+        self.rejected, self.head = description, None
+        self.seek(0)
+        self.truncate()
+
+    def check_header(self, fp, final):
+        magic = fp.read(12)
+        fp.seek(0)
+        if len(magic) < 12 and not final:
+            return
+        fmt = sniff_format(magic)
+        if fmt is None:
+            return self.reject(400, f"Invalid image: {self.filename}")
+        try:
+            img = Image.open(fp, formats=(fmt,))
+        except Image.DecompressionBombError:
+            img = None
+        except Exception:
+            if final:
+                return self.reject(400, f"Invalid image: {self.filename}")
+            return
+        if img is None or img.width * img.height > self.max_pixels:
+            return self.reject(413, f"Image too large: {self.filename} (max {self.max_pixels // 1_000_000} MP)")
+        self.format, self.size, self.pixels = fmt, img.size, img.width * img.height
+        self.head = None
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not filename or not allowed_filename(filename):
+            return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+        # /batch names its operation in the form, which is not parsed yet
+        route = (self.view_args or {}).get('op', self.endpoint)
+        return UploadSpool(filename, MAX_PIXELS.get(route, max(MAX_PIXELS.values())), route in MULTI_FILE_ROUTES)
+
+app.request_class = UploadRequest
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    return e.description, e.code
+
+def upload_error(f, route=None):
+    # Why a multi-file route's part is unusable, or None. /batch spools with
+    # the largest cap, so its operation's own cap is checked here
+    if not allowed_filename(f.filename or ''):
+        return 'Invalid type'
+    if route in MAX_PIXELS and (f.stream.pixels or 0) > MAX_PIXELS[route]:
+        return f"Image too large: {f.filename} (max {MAX_PIXELS[route] // 1_000_000} MP)"
+    return getattr(f.stream, 'rejected', None)
+
+def open_image(file_stream, max_pixels, size=None):
+    # Open, size-check and decode in one pass; returns the loaded,
+    # EXIF-transposed image, or None if the upload is unusable. With size,
+    # decode at the smallest power-of-two reduction that still covers it:
+    # DCT scaling via draft() for JPEG, reduce() for everything else
     try:
         img = Image.open(file_stream)
-        img.verify()
-        file_stream.seek(0)
+        # Checked against the header size, before draft() shrinks it
+        if img.width * img.height > max_pixels:
+            return None
+        if size:
+            w, h = size
+            if img.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+                w, h = h, w
+            if img.format == 'JPEG':
+                img.draft(None, (w, h))
+        img.load()
+        if size and img.format != 'JPEG' and min(w, h) > 0:
+            factor = 1
+            while img.width // (factor * 2) >= w and img.height // (factor * 2) >= h:
+                factor *= 2
+            if factor > 1 and img.mode not in ('P', '1'):
+                img = img.reduce(factor)
+        return ImageOps.exif_transpose(img)
+    except Exception:
+        return None
+
+# Results keyed by a hash of the upload and the normalized parameters. Entries
+# evicted from memory spill to RESULT_CACHE_DIR when it is set.
+class ResultCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(upload, *params):
+        h = hashlib.sha256(upload)
+        h.update(repr(params).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+        data = self._disk_get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            evicted = []
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+                evicted.append((old_key, old))
+        for old_key, old in evicted:
+            self._disk_put(old_key, old)
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(os.path.join(self.disk_dir, key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _disk_put(self, key, data):
+        if not self.disk_dir:
+            return
+        path = os.path.join(self.disk_dir, key)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.disk_dir, delete=False) as f:
+                f.write(data)
+            os.replace(f.name, path)
+            files = sorted((e.stat().st_mtime, e.stat().st_size, e.path)
+                           for e in os.scandir(self.disk_dir) if e.is_file())
+            total = sum(size for _, size, _ in files)
+            for _, size, p in files:
+                if total <= self.disk_max_bytes:
+                    break
+                os.remove(p)
+                total -= size
+        except OSError:
+            pass
+
+result_cache = ResultCache(
+    int(os.environ.get('RESULT_CACHE_MB', 64)) * 1024 * 1024,
+    os.environ.get('RESULT_CACHE_DIR'),
+    int(os.environ.get('RESULT_CACHE_DISK_MB', 512)) * 1024 * 1024)
+
+# Metrics: process-wide counters and per-stage timings, served at /metrics.
+# Stage timings are also collected per thread while a collector is active,
+# which is how requests get a Server-Timing header (with SERVER_TIMING set)
+# and how process-pool workers hand theirs back.
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') not in ('', '0')
+stats = {'encodes': 0, 'probe_encodes': 0, 'quality_searches': 0, 'fast_paths': 0, 'uploads_rejected': 0, 'bytes_in': 0, 'bytes_out': 0}
+stage_totals = {}  # stage -> [count, seconds]
+_stats_lock = threading.Lock()
+_collector = threading.local()
+
+def count(name, n=1):
+    with _stats_lock:
+        stats[name] += n
+
+def record(stage, seconds):
+    with _stats_lock:
+        totals = stage_totals.setdefault(stage, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+    timings = getattr(_collector, 'timings', None)
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+def collect_timings():
+    _collector.timings = []
+
+def take_timings():
+    timings, _collector.timings = getattr(_collector, 'timings', None) or [], None
+    return timings
+
+# JPEG size targeting
+JPEG_QMIN, JPEG_QMAX = 10, 95
+# Tried at JPEG_QMIN when the default settings (already 4:2:0 chroma) still overshoot
+JPEG_FALLBACKS = ({'progressive': True},)
+
+def encode_jpeg(img, quality, optimize=True, **opts):
+    count('encodes')
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality, optimize=optimize, **opts)
+    return out.getvalue()
+
+# Images over 4x this many pixels get a size prediction from a probe
+# downsampled to about this many pixels
+PROBE_PIXELS = 256 * 256
+
+class SizeModel:
+    # Predicts full-size bytes from probe bytes times the pixel ratio, scaled
+    # by a correction learned from (predicted, actual) pairs. save holds the
+    # encoder options, JPEG by default
+    def __init__(self, ratio=1.0, alpha=0.2, save=None):
+        self.ratio = ratio
+        self.alpha = alpha
+        self.save = save or {'format': 'JPEG', 'optimize': True}
+        self.lock = threading.Lock()
+
+    def probe(self, img):
+        pixels = img.width * img.height
+        if pixels <= PROBE_PIXELS * 4:
+            return None
+        scale = (PROBE_PIXELS / pixels) ** 0.5
+        small = img.resize((max(8, round(img.width * scale)), max(8, round(img.height * scale))), Image.BOX)
+        return SizeProbe(self, small, pixels / (small.width * small.height))
+
+    def observe(self, estimate, actual):
+        with self.lock:
+            self.ratio += self.alpha * (actual / estimate - self.ratio)
+
+class SizeProbe:
+    def __init__(self, model, img, pixel_ratio):
+        self.model = model
+        self.img = img
+        self.pixel_ratio = pixel_ratio
+        self.ratio = model.ratio
+        self.sizes = {}
+
+    def estimate(self, quality):
+        if quality not in self.sizes:
+            count('probe_encodes')
+            out = io.BytesIO()
+            self.img.save(out, quality=quality, **self.model.save)
+            self.sizes[quality] = out.tell()
+        return self.sizes[quality] * self.pixel_ratio
+
+    def predict(self, quality):
+        return self.estimate(quality) * self.ratio
+
+    def observe(self, quality, actual):
+        # Later predictions for this image use its own correction
+        self.model.observe(self.estimate(quality), actual)
+        self.ratio = actual / self.estimate(quality)
+
+    def best_quality(self, maxbytes, qmin, qmax):
+        # Largest quality in [qmin, qmax] predicted to fit, or None
+        best = None
+        while qmin <= qmax:
+            q = (qmin + qmax) // 2
+            if self.predict(q) <= maxbytes:
+                best = q
+                qmin = q + 1
+            else:
+                qmax = q - 1
+        return best
+
+size_model = SizeModel()
+FORMAT_SIZE_MODELS = {'progressive': SizeModel(save={'format': 'JPEG', 'optimize': True, 'progressive': True}),
+                      'webp': SizeModel(save={'format': 'WEBP', 'method': 4})}
+
+# Real encodes fit_predicted() spends before handing over to bisection
+PREDICT_ENCODES = 3
+
+def fit_predicted(encode, probe, maxbytes, qmin, qmax):
+    # Encode at the predicted quality, re-predict with this image's own
+    # correction and repeat, narrowing [lo, hi] as encodes fit or miss.
+    # Returns (data, quality) or, if nothing fitted yet, the range left to
+    # search and the smallest encode so far
+    best = smallest = None
+    lo, hi = qmin, qmax
+    q = probe.best_quality(maxbytes, lo, hi) or lo
+    for _ in range(PREDICT_ENCODES):
+        data = encode(q)
+        probe.observe(q, len(data))
+        if len(data) <= maxbytes:
+            best = (data, q)
+            lo = q + 1
+        else:
+            smallest = data
+            hi = q - 1
+        if lo > hi:
+            break
+        q = probe.best_quality(maxbytes, lo, hi)
+        if q is None:
+            if best:
+                break
+            q = lo
+    return best, (lo, hi), smallest
+
+def fit_jpeg(img, maxbytes, qmin=JPEG_QMIN, qmax=JPEG_QMAX, probe=None):
+    # Largest quality in [qmin, qmax] that fits. Large images start from the
+    # size model's prediction; the rest, and predictions that miss, bisect.
+    # If nothing fits, the smallest encode out of qmin and the fallbacks
+    probe = probe or size_model.probe(img)
+    if probe:
+        found, bounds, smallest = fit_predicted(functools.partial(encode_jpeg, img), probe, maxbytes, qmin, qmax)
+        if found:
+            return found
+        lo, hi = bounds
+    else:
+        data = encode_jpeg(img, qmax)
+        if len(data) <= maxbytes:
+            return data, qmax
+        lo, hi, smallest = qmin, qmax - 1, data
+    best = None
+    while lo <= hi:
+        q = (lo + hi) // 2
+        data = encode_jpeg(img, q)
+        if len(data) <= maxbytes:
+            best = (data, q)
+            lo = q + 1
+        else:
+            smallest = data
+            hi = q - 1
+    if best:
+        return best
+    for opts in JPEG_FALLBACKS:
+        data = encode_jpeg(img, qmin, **opts)
+        if len(data) < len(smallest):
+            smallest = data
+        if len(data) <= maxbytes:
+            break
+    return smallest, qmin
+
+# Share of the target the qmin encode may use after downscaling; the rest is
+# left for fit_jpeg to spend on quality
+PLAN_HEADROOM = 0.5
+PLAN_ROUNDS = 3
+
+def fit_jpeg_scaled(img, maxbytes, qmin=JPEG_QMIN, qmax=JPEG_QMAX):
+    # Like fit_jpeg, but when even qmin overshoots at full size, use the
+    # bytes-per-pixel of that encode to pick a scale, then fit quality there.
+    # A prediction that qmin overshoots is checked with one real encode
+    probe = size_model.probe(img)
+    if probe is None or probe.predict(qmin) <= maxbytes:
+        data, quality = fit_jpeg(img, maxbytes, qmin, qmax, probe)
+        if len(data) <= maxbytes:
+            return data, quality
+    else:
+        data = encode_jpeg(img, qmin)
+        probe.observe(qmin, len(data))
+        if len(data) <= maxbytes:
+            return fit_jpeg(img, maxbytes, qmin, qmax, probe)
+    qmin_size = len(data)
+    w, h = img.size
+    scale = 1.0
+    for _ in range(PLAN_ROUNDS):
+        bpp = qmin_size / (w * h)
+        scale *= min(1.0, (maxbytes * PLAN_HEADROOM / bpp / (w * h)) ** 0.5)
+        w, h = max(1, round(img.width * scale)), max(1, round(img.height * scale))
+        small = img.resize((w, h), Image.LANCZOS)
+        data = encode_jpeg(small, qmin)
+        qmin_size = len(data)
+        if qmin_size <= maxbytes:
+            return fit_jpeg(small, maxbytes, qmin, qmax)
+    return data, qmin
+
+# Other output formats for /compress. Each fit returns (data, quality) like
+# fit_jpeg, with lossless results counting as quality 100
+def encode_webp(img, quality, lossless=False):
+    count('encodes')
+    out = io.BytesIO()
+    img.save(out, format='WEBP', quality=quality, lossless=lossless, method=4)
+    return out.getvalue()
+
+def is_gray(img):
+    if img.mode in ('L', 'LA'):
         return True
-    except:
+    if img.mode != 'RGB':
+        return False
+    r, g, b = img.split()
+    return ImageChops.difference(r, g).getbbox() is None and ImageChops.difference(g, b).getbbox() is None
+
+def encode_png_palette(img, colors):
+    count('encodes')
+    out = io.BytesIO()
+    if img.mode == 'RGBA' or img.getcolors(colors) is None:
+        # FASTOCTREE collapses grays to a handful of levels, so gray images
+        # are quantized from L (median cut) instead
+        if is_gray(img):
+            img = img.convert('L').quantize(colors)
+        else:
+            img = img.quantize(colors, method=Image.Quantize.FASTOCTREE)
+    else:
+        img = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=colors)
+    img.save(out, format='PNG', optimize=True)
+    return out.getvalue()
+
+def fit_quality(encode, maxbytes, qmin=JPEG_QMIN, qmax=JPEG_QMAX, lowest=None, probe=None):
+    # fit_jpeg's search for any encode(quality) that grows with quality,
+    # starting from probe's prediction when given. Gives up after the qmin
+    # encode (or lowest, if already made) overshoots
+    best = (lowest or encode(qmin), qmin)
+    if len(best[0]) > maxbytes or qmin == qmax:
+        return best
+    if probe:
+        found, (lo, hi), _ = fit_predicted(encode, probe, maxbytes, qmin + 1, qmax)
+        if found:
+            return found
+    else:
+        data = encode(qmax)
+        if len(data) <= maxbytes:
+            return data, qmax
+        lo, hi = qmin + 1, qmax - 1
+    while lo <= hi:
+        q = (lo + hi) // 2
+        data = encode(q)
+        if len(data) <= maxbytes:
+            best = (data, q)
+            lo = q + 1
+        else:
+            hi = q - 1
+    return best
+
+# encode(img, setting) and the setting's range for the other formats. The
+# setting stands in for quality: colours for PNG, 100 for lossless WebP
+FORMAT_ENCODERS = {
+    'progressive': (lambda img, q: encode_jpeg(img, q, progressive=True), JPEG_QMIN, JPEG_QMAX),
+    'webp': (encode_webp, JPEG_QMIN, JPEG_QMAX),
+    'webp_lossless': (lambda img, _: encode_webp(img, 100, lossless=True), 100, 100),
+    'png': (encode_png_palette, 64, 256),
+}
+OUTPUT_FORMATS = ('jpeg', 'auto') + tuple(FORMAT_ENCODERS)
+# Quantizing is slow enough that PNG colour searches run on at most this many
+# pixels; the count found there is encoded once at the output size
+PNG_QUANTIZE_PIXELS = 2_000_000
+
+def fit_scaled(img, maxbytes, fmt):
+    # fit_jpeg_scaled's planning for the other formats: one encode at the
+    # lowest setting decides whether the image needs downscaling, and its
+    # bytes-per-pixel picks the scale; the setting is fitted only at the end
+    encode, lo, hi = FORMAT_ENCODERS[fmt]
+    small = img
+    data = encode(small, lo)
+    scale = 1.0
+    for _ in range(PLAN_ROUNDS):
+        if len(data) <= maxbytes:
+            probe = fmt in FORMAT_SIZE_MODELS and FORMAT_SIZE_MODELS[fmt].probe(small)
+            return fit_quality(functools.partial(encode, small), maxbytes, lo, hi, data, probe)
+        scale *= min(1.0, (maxbytes * PLAN_HEADROOM / len(data)) ** 0.5)
+        small = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+        data = encode(small, lo)
+    return data, lo
+
+# A continuous-tone grayscale image, which every L upload becomes, fits in
+# 256 colours too; only this many gray levels count as a palette
+PALETTE_GRAY_LEVELS = 16
+# auto tries lossless candidates only up to this size, lossless WebP taking
+# about a second per megapixel, and lossless WebP only when the exact-palette
+# PNG comes within LOSSLESS_WEBP_REACH times the target
+AUTO_LOSSLESS_PIXELS = 2_000_000
+LOSSLESS_WEBP_REACH = 2
+
+def has_few_colors(img):
+    # Whether img has an exact palette worth encoding losslessly
+    colors = img.mode != 'RGBA' and img.getcolors(256)
+    if not colors:
         return False
+    return len(colors) <= PALETTE_GRAY_LEVELS or any(len(set(c[:3])) > 1 for _, c in colors
+                                                     if isinstance(c, tuple))
+
+def scaled(img, scale):
+    if scale >= 1:
+        return img
+    return img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+
+def fit_png(img, maxbytes):
+    # Exact palettes are lossless. Otherwise the colour count runs from the
+    # format's minimum up, and resolution gives way only once that minimum
+    # overshoots. Counts are tried on a copy of at most PNG_QUANTIZE_PIXELS,
+    # its bytes times the pixel ratio standing in for the output's
+    if has_few_colors(img):
+        data = encode_png_palette(img, 256)
+        if len(data) <= maxbytes:
+            return data, 100
+    encode, lo, hi = FORMAT_ENCODERS['png']
+    scale, best = 1.0, None
+    for _ in range(PLAN_ROUNDS):
+        pixels = img.width * img.height * scale * scale
+        work = scaled(img, min(scale, (PNG_QUANTIZE_PIXELS / (img.width * img.height)) ** 0.5))
+        ratio = pixels / (work.width * work.height)
+        data = encode(work, lo)
+        if len(data) * ratio > maxbytes:
+            scale *= min(1.0, (maxbytes * PLAN_HEADROOM / (len(data) * ratio)) ** 0.5)
+            best = best or (data, lo)
+            continue
+        data, colors = fit_quality(functools.partial(encode, work), maxbytes / ratio, lo, hi, data)
+        if ratio > 1:
+            data = encode(scaled(img, scale), colors)
+        best = (data, colors)
+        if len(data) <= maxbytes:
+            break
+        scale *= (maxbytes / len(data)) ** 0.5 * 0.95
+    return best
+
+def fit_auto(img, maxbytes):
+    # Highest quality among the formats that fit, smallest on ties; lossless
+    # candidates only for small images with an exact palette. If none fits,
+    # JPEG with downscaling
+    rgb = img.convert('RGB')
+    candidates = [fit_jpeg(rgb, maxbytes),
+                  fit_quality(functools.partial(encode_webp, img), maxbytes, probe=FORMAT_SIZE_MODELS['webp'].probe(img))]
+    if img.width * img.height <= AUTO_LOSSLESS_PIXELS and has_few_colors(img):
+        png = encode_png_palette(img, 256)
+        candidates.append((png, 100))
+        if len(png) <= maxbytes * LOSSLESS_WEBP_REACH:
+            candidates.append((encode_webp(img, 100, lossless=True), 100))
+    fitting = [c for c in candidates if len(c[0]) <= maxbytes]
+    if fitting:
+        return max(fitting, key=lambda c: (c[1], -len(c[0])))
+    return fit_jpeg_scaled(rgb, maxbytes)
+
+def fit_format(img, maxbytes, fmt):
+    if fmt == 'jpeg':
+        return fit_jpeg_scaled(img.convert('RGB'), maxbytes)
+    if fmt == 'auto':
+        return fit_auto(img, maxbytes)
+    if fmt == 'png':
+        return fit_png(img, maxbytes)
+    if fmt == 'progressive':
+        img = img.convert('RGB')
+    return fit_scaled(img, maxbytes, fmt)
+
+def output_name(name, data):
+    # Swap the extension of a download name for the format of data
+    ext = '.webp' if data[:4] == b'RIFF' else '.png' if data[:4] == b'\x89PNG' else '.jpg'
+    return os.path.splitext(name)[0] + ext
+
+# Lossless JPEG transforms, through jpegtran when it is on PATH. Results keep
+# the ICC profile and drop the rest of the metadata, orientation included,
+# since it has been applied.
+JPEGTRAN = shutil.which('jpegtran')
+JPEGTRAN_TIMEOUT = 30
+T = Image.Transpose
+# EXIF orientation -> the transpose that undoes it
+ORIENTATION_TRANSPOSES = {2: T.FLIP_LEFT_RIGHT, 3: T.ROTATE_180, 4: T.FLIP_TOP_BOTTOM, 5: T.TRANSPOSE,
+                          6: T.ROTATE_270, 7: T.TRANSVERSE, 8: T.ROTATE_90}
+JPEGTRAN_ARGS = {T.FLIP_LEFT_RIGHT: ('-flip', 'horizontal'), T.FLIP_TOP_BOTTOM: ('-flip', 'vertical'),
+                 T.ROTATE_90: ('-rotate', '270'), T.ROTATE_180: ('-rotate', '180'), T.ROTATE_270: ('-rotate', '90'),
+                 T.TRANSPOSE: ('-transpose',), T.TRANSVERSE: ('-transverse',)}
+# Distinct pixels, so a sequence of transposes can be matched to a single one
+_TRANSPOSE_PROBE = Image.frombytes('L', (3, 2), bytes(range(6)))
+
+def compose_transposes(methods):
+    # The one transpose equal to applying methods in order, None for identity
+    img = _TRANSPOSE_PROBE
+    for method in methods:
+        img = img.transpose(method)
+    if img.size == _TRANSPOSE_PROBE.size and img.tobytes() == _TRANSPOSE_PROBE.tobytes():
+        return None
+    for method in T:
+        t = _TRANSPOSE_PROBE.transpose(method)
+        if t.size == img.size and t.tobytes() == img.tobytes():
+            return method
+
+def user_transposes(rotate, flip):
+    # The Rotate tab draws the flipped image rotated clockwise
+    methods = [T.FLIP_LEFT_RIGHT] if 'h' in flip else []
+    methods += [T.FLIP_TOP_BOTTOM] if 'v' in flip else []
+    methods += {0: [], 90: [T.ROTATE_270], 180: [T.ROTATE_180], 270: [T.ROTATE_90]}[rotate]
+    return methods
+
+def jpegtran(raw, *args):
+    # None if jpegtran is missing or refuses, e.g. -perfect with partial edge blocks
+    if not JPEGTRAN:
+        return None
+    try:
+        done = subprocess.run([JPEGTRAN, '-copy', 'icc', *args], input=raw, capture_output=True,
+                              timeout=JPEGTRAN_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return done.stdout if done.returncode == 0 and done.stdout else None
+
+def jpeg_orientation(raw, route):
+    # EXIF orientation of JPEG bytes within MAX_PIXELS[route], or None for
+    # anything else, which the pipeline then decodes or rejects as usual
+    try:
+        img = Image.open(io.BytesIO(raw))
+    except Exception:
+        return None
+    if img.format != 'JPEG' or img.width * img.height > MAX_PIXELS[route]:
+        return None
+    return img.getexif().get(ExifTags.Base.Orientation, 1)
+
+# Segments strip_jpeg_metadata keeps: JFIF (APP0), ICC profiles (APP2) and
+# Adobe (APP14), which change how the image decodes. Other APPn segments
+# (EXIF, XMP, thumbnails, maker data) and comments go.
+JPEG_KEEP_SEGMENTS = {0xE0: b'', 0xE2: b'ICC_PROFILE', 0xEE: b''}
+
+def strip_jpeg_metadata(raw, orientation=1):
+    # Walk the marker segments up to the first scan; None if they don't parse.
+    # An orientation other than 1 is kept as the only tag of a fresh EXIF
+    # segment, after JFIF if there is one
+    if raw[:2] != b'\xff\xd8':
+        return None
+    out, i = [raw[:2]], 2
+    while i + 4 <= len(raw):
+        if raw[i] != 0xFF:
+            return None
+        marker = raw[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0xDA:
+            if orientation != 1:
+                exif = Image.Exif()
+                exif[ExifTags.Base.Orientation] = orientation
+                payload = exif.tobytes()
+                at = 2 if len(out) > 1 and out[1][1] == 0xE0 else 1
+                out.insert(at, b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload)
+            out.append(raw[i:])
+            return b''.join(out)
+        end = i + 2 + int.from_bytes(raw[i + 2:i + 4], 'big')
+        if end > len(raw):
+            return None
+        metadata = 0xE0 <= marker <= 0xEF or marker == 0xFE
+        keep = JPEG_KEEP_SEGMENTS.get(marker)
+        if not metadata or (keep is not None and raw[i + 4:end].startswith(keep)):
+            out.append(raw[i:end])
+        i = end
+    return None
+
+def lossless_transpose(raw, route, methods=()):
+    # JPEG bytes with the EXIF orientation and then methods applied in the
+    # DCT domain, or None if that is not possible
+    orientation = jpeg_orientation(raw, route)
+    if orientation is None:
+        return None
+    fix = [ORIENTATION_TRANSPOSES[orientation]] if orientation in ORIENTATION_TRANSPOSES else []
+    method = compose_transposes(fix + list(methods))
+    if method is None:
+        return jpegtran(raw)
+    return jpegtran(raw, '-perfect', *JPEGTRAN_ARGS[method])
+
+def crop_box(size, x, y, w, h):
+    # Clamp a crop rectangle to the image; (left, upper, right, lower)
+    x, y = min(max(0, x), size[0] - 1), min(max(0, y), size[1] - 1)
+    return x, y, min(size[0], x + max(1, w)), min(size[1], y + max(1, h))
+
+def lossless_crop(raw, route, box, snap=False):
+    # Crop JPEG bytes without re-encoding. jpegtran can only start a crop on
+    # an MCU boundary, so an unaligned origin either moves up and left to
+    # one (snap) or rules the lossless path out
+    oriented = lossless_transpose(raw, route)
+    if oriented is None:
+        return None
+    img = Image.open(io.BytesIO(oriented))
+    mcu_w = 8 * max(layer[1] for layer in img.layer)
+    mcu_h = 8 * max(layer[2] for layer in img.layer)
+    left, upper, right, lower = crop_box(img.size, *box)
+    if left % mcu_w or upper % mcu_h:
+        if not snap:
+            return None
+        left -= left % mcu_w
+        upper -= upper % mcu_h
+    return jpegtran(oriented, '-crop', f'{right - left}x{lower - upper}+{left}+{upper}')
+
+# Filters of the Filters tab, matching its CSS filters
+SEPIA = (0.393, 0.769, 0.189, 0, 0.349, 0.686, 0.168, 0, 0.272, 0.534, 0.131, 0)
+FILTERS = {
+    'none': lambda img: img,
+    'grayscale': lambda img: ImageOps.grayscale(img).convert('RGB'),
+    'sepia': lambda img: img.convert('RGB', SEPIA),
+    'blur': lambda img: img.filter(ImageFilter.GaussianBlur(3)),
+    'brightness': lambda img: ImageEnhance.Brightness(img).enhance(1.3),
+    'contrast': lambda img: ImageEnhance.Contrast(img).enhance(1.3),
+    'saturate': lambda img: ImageEnhance.Color(img).enhance(1.5),
+    'invert': ImageOps.invert,
+}
 
-def save_temp_bytes(b: bytes, suffix=''):
-    name = f"{uuid.uuid4().hex}{suffix}"
-    path = os.path.join(tempfile.gettempdir(), name)
-    with open(path, 'wb') as f:
-        f.write(b)
-    return path
+def apply_filter(img, name):
+    img = expand_palette(img)
+    alpha = img.getchannel('A') if img.mode in ('RGBA', 'LA') else None
+    img = FILTERS[name](img.convert('RGB'))
+    if alpha:
+        img.putalpha(alpha)
+    return img
+
+def encode_png(img):
+    count('encodes')
+    out = io.BytesIO()
+    img.save(out, format='PNG', optimize=True)
+    return out.getvalue()
+
+# Image pipeline. Routes describe their work as a list of stages:
+#   ('open', route)          decode, size-checked against MAX_PIXELS[route]
+#   ('flatten',)             alpha onto white, result RGB
+#   ('rgb',)                 plain RGB conversion
+#   ('resize', (w, h)[, resample])  exact resize, LANCZOS by default
+#   ('thumbnail', max_side)  LANCZOS downscale to fit max_side, aspect kept
+#   ('color',)               RGB, or RGBA if the image has transparency
+#   ('crop', (x, y, w, h))   crop, clamped to the image
+#   ('face_crop', (w, h))    crop to the aspect ratio of (w, h) around a face
+#   ('clean_signature', mode, (w, h))  whiten, threshold and trim a signature
+#   ('transpose', method)    one of Image.Transpose
+#   ('filter', name)         one of FILTERS, alpha kept
+# ending in one encoder stage: ('encode', quality), ('preview', quality)
+# (no Huffman optimization), ('png',), ('fit', maxbytes), ('fit_scaled',
+# maxbytes) or ('fit_format', maxbytes, format). plan() reorders and fuses them before
+# running.
+def expand_palette(img):
+    # Resampling palette or bilevel images falls back to NEAREST
+    if img.mode == 'P':
+        return img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    if img.mode == '1':
+        return img.convert('L')
+    return img
+
+def flatten_rgb(img):
+    img = expand_palette(img)
+    if img.mode in ('RGBA', 'LA'):
+        bg = Image.new('RGB', img.size, (255, 255, 255))
+        bg.paste(img.convert('RGBA'), mask=img.getchannel('A'))
+        return bg
+    return img.convert('RGB')
+
+def thumbnail(img, max_side):
+    if max(img.size) <= max_side:
+        return img
+    img = expand_palette(img)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    return img
+
+# Passport auto-crop. Faces are found with OpenCV's Haar cascade, when
+# opencv-python-headless is installed, on a grayscale thumbnail of at most
+# FACE_DETECT_SIDE pixels; faces under FACE_MIN_SHARE of its short side are
+# not searched for, which keeps detection to a few tens of ms. The crop puts the largest face at a passport-style
+# scale and position, and falls back to an upper-center crop when there is no
+# face or no OpenCV. Either way the crop has the output's aspect ratio, so the
+# final resize no longer distorts.
+try:
+    import cv2
+    import numpy
+    FACE_CASCADE_PATH = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+    cv2.setNumThreads(1)
+except ImportError:
+    cv2 = None
+FACE_DETECT_SIDE = 320
+FACE_MIN_SHARE = 1 / 6
+FACE_HEIGHT_SHARE = 0.45   # detected face box height / crop height
+FACE_CENTER_Y = 0.45       # face box center, as a fraction of the crop height
+FALLBACK_TOP = 0.25        # share of the spare height left above a fallback crop
+_face_detectors = threading.local()
+
+def detect_face(img):
+    # Largest face as (x, y, w, h) in img coordinates, or None
+    if cv2 is None:
+        return None
+    detector = getattr(_face_detectors, 'cascade', None)
+    if detector is None:
+        detector = _face_detectors.cascade = cv2.CascadeClassifier(FACE_CASCADE_PATH)
+    small = img.copy()
+    small.thumbnail((FACE_DETECT_SIDE, FACE_DETECT_SIDE), Image.BILINEAR, reducing_gap=2.0)
+    small = ImageOps.grayscale(small)
+    min_side = max(24, int(min(small.size) * FACE_MIN_SHARE))
+    faces = detector.detectMultiScale(numpy.asarray(small), scaleFactor=1.2, minNeighbors=5,
+                                      minSize=(min_side, min_side))
+    if len(faces) == 0:
+        return None
+    scale = img.width / small.width
+    x, y, w, h = (int(v) for v in max(faces, key=lambda f: f[2] * f[3]))
+    return x * scale, y * scale, w * scale, h * scale
+
+def face_crop(img, size):
+    # Crop to the aspect ratio of size around the face, if there is one
+    aspect = size[0] / size[1]
+    face = detect_face(img)
+    if face:
+        x, y, w, h = face
+        ch = min(h / FACE_HEIGHT_SHARE, img.height, img.width / aspect)
+        cw = ch * aspect
+        left = x + w / 2 - cw / 2
+        top = y + h / 2 - ch * FACE_CENTER_Y
+    else:
+        ch = min(img.height, img.width / aspect)
+        cw = ch * aspect
+        left = (img.width - cw) / 2
+        top = (img.height - ch) * FALLBACK_TOP
+    left = min(max(0, left), img.width - cw)
+    top = min(max(0, top), img.height - ch)
+    return img.crop((round(left), round(top), round(left + cw), round(top + ch)))
+
+# Signature cleanup for photographed signatures. Ink is what is darker than
+# a box-blurred estimate of the paper around it by more than an Otsu
+# threshold; everything else turns white, which also removes shading. The
+# result is trimmed to the ink plus a margin and padded with white to the
+# output's aspect ratio. Modes: 'color' keeps the ink's color, 'gray' is
+# grayscale and 'bw' pure black on white (two-level 'L', as JPEG has no
+# 1-bit mode).
+SIGNATURE_MODES = ('color', 'gray', 'bw')
+SIGNATURE_BLUR = 1 / 16     # background box radius, as a share of the long side
+SIGNATURE_MIN_INK = 12      # least darkening that can count as ink
+SIGNATURE_MARGIN = 0.05     # margin kept around the ink, as a share of its size
+
+def ink_threshold(diff):
+    # Otsu's threshold of the darkening histogram
+    hist = diff.histogram()
+    total, total_sum = sum(hist), sum(i * n for i, n in enumerate(hist))
+    best, best_var, w0, sum0 = 0, 0, 0, 0
+    for t, n in enumerate(hist):
+        w0 += n
+        sum0 += t * n
+        w1 = total - w0
+        if w0 == 0:
+            continue
+        if w1 == 0:
+            break
+        var = w0 * w1 * (sum0 / w0 - (total_sum - sum0) / w1) ** 2
+        if var > best_var:
+            best, best_var = t, var
+    return max(best + 1, SIGNATURE_MIN_INK)
+
+def clean_signature(img, mode, size):
+    gray = ImageOps.grayscale(img)
+    radius = max(4, round(max(gray.size) * SIGNATURE_BLUR))
+    diff = ImageChops.subtract(gray.filter(ImageFilter.BoxBlur(radius)), gray)
+    t = ink_threshold(diff)
+    lo = t // 2
+    # Ink coverage, ramped between lo and t for smooth stroke edges
+    ink = diff.point(lambda v: 0 if v < lo else 255 if v >= t else (v - lo) * 255 // (t - lo))
+    ink = ink.filter(ImageFilter.MedianFilter(3))
+    if mode == 'bw':
+        img = ink.point(lambda v: 0 if v >= 128 else 255)
+    elif mode == 'gray':
+        img = Image.composite(gray, Image.new('L', gray.size, 255), ink)
+    else:
+        img = Image.composite(img.convert('RGB'), Image.new('RGB', gray.size, (255, 255, 255)), ink)
+    box = ink.getbbox()
+    if box:
+        mx = round((box[2] - box[0]) * SIGNATURE_MARGIN)
+        my = round((box[3] - box[1]) * SIGNATURE_MARGIN)
+        img = img.crop(crop_box(img.size, box[0] - mx, box[1] - my, box[2] - box[0] + 2 * mx, box[3] - box[1] + 2 * my))
+    aspect = size[0] / size[1]
+    w, h = img.size
+    w, h = max(w, round(h * aspect)), max(h, round(w / aspect))
+    if (w, h) != img.size:
+        padded = Image.new(img.mode, (w, h), 255 if img.mode == 'L' else (255, 255, 255))
+        padded.paste(img, ((w - img.width) // 2, (h - img.height) // 2))
+        img = padded
+    return img
+
+STAGES = {
+    'flatten': flatten_rgb,
+    'rgb': lambda img: img.convert('RGB'),
+    'color': lambda img: img.convert('RGBA' if expand_palette(img).mode in ('RGBA', 'LA') else 'RGB'),
+    'resize': lambda img, size, resample=Image.LANCZOS: expand_palette(img).resize(size, resample),
+    'thumbnail': thumbnail,
+    'crop': lambda img, box: img.crop(crop_box(img.size, *box)),
+    'face_crop': face_crop,
+    'clean_signature': clean_signature,
+    'transpose': lambda img, method: img.transpose(method),
+    'filter': apply_filter,
+}
+ENCODERS = {
+    'encode': encode_jpeg,
+    'preview': lambda img, quality: encode_jpeg(img, quality, optimize=False),
+    'png': encode_png,
+    'fit': lambda img, maxbytes: fit_jpeg(img, maxbytes)[0],
+    'fit_scaled': lambda img, maxbytes: fit_jpeg_scaled(img, maxbytes)[0],
+    'fit_format': lambda img, maxbytes, fmt: fit_format(img, maxbytes, fmt)[0],
+}
+STAGE_METRICS = {'flatten': 'convert', 'rgb': 'convert', 'color': 'convert', 'resize': 'resize', 'thumbnail': 'resize',
+                 'crop': 'edit', 'transpose': 'edit', 'filter': 'edit', 'face_crop': 'detect',
+                 'clean_signature': 'clean'}
+# Per-pixel stages commute with resampling, so they can run after a downscale
+PIXEL_STAGES = {'flatten', 'rgb', 'color'}
+SCALE_STAGES = {'resize', 'thumbnail'}
+
+def plan(stages):
+    # Move the first downscale up to just after 'open' and pass its size to
+    # open as the draft/reduce hint, so every later stage sees the small
+    # image; then drop conversions that an earlier stage already did
+    stages = list(stages)
+    for i, stage in enumerate(stages):
+        if stage[0] in SCALE_STAGES:
+            j = i
+            while j > 1 and stages[j - 1][0] in PIXEL_STAGES:
+                j -= 1
+            stages.insert(j, stages.pop(i))
+            if j == 1 and stages[0][0] == 'open':
+                hint = stage[1] if stage[0] == 'resize' else (stage[1], stage[1])
+                stages[0] = stages[0][:2] + (hint,)
+            break
+    planned = []
+    for stage in stages:
+        if stage[0] == 'rgb' and planned and planned[-1][0] in PIXEL_STAGES:
+            continue
+        planned.append(stage)
+    return planned
+
+def run_pipeline(raw, stages):
+    # Returns (encoded bytes, image as handed to the encoder), or None if the
+    # upload is not a usable image
+    img = None
+    for name, *args in plan(stages):
+        if name == 'open':
+            with timed('decode'):
+                img = open_image(io.BytesIO(raw), MAX_PIXELS[args[0]], *args[1:])
+            if img is None:
+                return None
+        elif name in ENCODERS:
+            if name in ('fit', 'fit_scaled', 'fit_format'):
+                count('quality_searches')
+            with timed('encode'):
+                return ENCODERS[name](img, *args), img
+        else:
+            with timed(STAGE_METRICS[name]):
+                img = STAGES[name](img, *args)
+    raise ValueError('pipeline has no encoder stage')
+
+# Pipelines run on the calling thread, or with WORKER_PROCESSES > 0 in a pool
+# of forkserver processes started on first use and warmed with Pillow's
+# plugins loaded. Uploads reach the workers through shared memory instead of
+# being pickled. Each task has a worker to itself, so a task running past
+# WORKER_TIMEOUT only costs its own worker, which is killed and replaced.
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 0))
+WORKER_TIMEOUT = float(os.environ.get('WORKER_TIMEOUT', 120))
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _warm_worker():
+    Image.init()
+    encode_jpeg(Image.new('RGB', (16, 16)), 75)
+    detect_face(Image.new('L', (64, 64)))
+
+def _run_local(raw, stages):
+    result = run_pipeline(raw, stages)
+    if result is None:
+        return None
+    data, img = result
+    return data, img.mode, img.size
+
+def _run_shared(name, size, stages):
+    # Also returns this task's stage timings and counter increments, which
+    # would otherwise stay in the worker process
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        raw = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    before = dict(stats)
+    collect_timings()
+    result = _run_local(raw, stages)
+    return result, take_timings(), {k: stats[k] - before[k] for k in stats}
+
+def _worker_main(conn):
+    _warm_worker()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = (_run_shared(*task), None)
+        except Exception as e:
+            reply = (None, e)
+        try:
+            conn.send(reply)
+        except Exception:
+            # The exception itself did not pickle
+            conn.send((None, RuntimeError(str(reply[1]))))
+
+class Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_main, args=(child,), daemon=True)
+        self.proc.start()
+        child.close()
+
+    def run(self, task, timeout):
+        # (result, exception raised by the task); raises if the worker fails
+        self.conn.send(task)
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"processing took longer than {timeout:g}s")
+        try:
+            return self.conn.recv()
+        except EOFError:
+            raise RuntimeError("worker process died") from None
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+class WorkerPool:
+    # Lends each task an idle worker. A worker that times out or dies is
+    # killed and replaced; the tasks on the other workers carry on
+    def __init__(self, size):
+        self.ctx = get_context('forkserver')
+        self.idle = [Worker(self.ctx) for _ in range(size)]
+        self.lock = threading.Lock()
+        self.free = threading.Semaphore(size)
+
+    def run(self, task, timeout):
+        self.free.acquire()
+        with self.lock:
+            worker = self.idle.pop()
+        try:
+            result, error = worker.run(task, timeout)
+        except BaseException:
+            worker.kill()
+            worker = Worker(self.ctx)
+            raise
+        finally:
+            with self.lock:
+                self.idle.append(worker)
+            self.free.release()
+        if error is not None:
+            raise error
+        return result
+
+def process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = WorkerPool(WORKER_PROCESSES)
+        return _process_pool
+
+def process_upload(raw, stages):
+    # Returns (encoded bytes, mode, size of the image handed to the encoder),
+    # or None if the upload is not a usable image
+    if not WORKER_PROCESSES:
+        return _run_local(raw, stages)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(raw)))
+    try:
+        shm.buf[:len(raw)] = raw
+        result, timings, counts = process_pool().run((shm.name, len(raw), stages), WORKER_TIMEOUT)
+    finally:
+        shm.close()
+        shm.unlink()
+    for stage, seconds in timings:
+        record(stage, seconds)
+    for name, n in counts.items():
+        count(name, n)
+    return result
+
+# /to_pdf pages are decoded and flattened concurrently; Pillow releases the
+# GIL while decoding. The pool is shared, so PDF_WORKERS bounds all batches.
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 4))
+page_pool = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix='pdf-page')
+
+def page_stages(max_side=None, maxbytes=None, quality=85):
+    stages = [('open', 'to_pdf'), ('flatten',)]
+    if max_side:
+        stages.append(('thumbnail', max_side))
+    return stages + [('fit_scaled', maxbytes) if maxbytes else ('encode', quality)]
+
+def encode_page(raw, max_side=None, maxbytes=None, quality=85):
+    # Runs on the page pool, so only the JPEG bytes outlive the decoded page
+    result = process_upload(raw, page_stages(max_side, maxbytes, quality))
+    if result is None:
+        return None
+    data, mode, size = result
+    return data, Image.open(io.BytesIO(data)).size, mode, size
+
+# Bytes of PDF structure around the image streams, for splitting a size budget
+PDF_OVERHEAD, PDF_PAGE_OVERHEAD = 400, 450
+# Smallest image stream a page can be given and still show something
+PDF_MIN_PAGE_BYTES = 1024
+
+def page_budgets(uploads, maxbytes, max_side=None):
+    # Give each page PDF_MIN_PAGE_BYTES and split the rest of maxbytes by
+    # pixel count, read from the headers only; pages whose header cannot be
+    # read get no budget and are dropped. Raises ValueError if maxbytes cannot
+    # cover the PDF structure and those minimums
+    pixels = []
+    for raw in uploads:
+        try:
+            w, h = Image.open(io.BytesIO(raw)).size
+        except Exception:
+            w = h = 0
+        if max_side and max(w, h) > max_side:
+            scale = max_side / max(w, h)
+            w, h = w * scale, h * scale
+        pixels.append(w * h)
+    total = sum(pixels)
+    valid = sum(1 for p in pixels if p)
+    budget = maxbytes - PDF_OVERHEAD - PDF_PAGE_OVERHEAD * valid
+    if valid and budget < PDF_MIN_PAGE_BYTES * valid:
+        needed = PDF_OVERHEAD + (PDF_PAGE_OVERHEAD + PDF_MIN_PAGE_BYTES) * valid
+        raise ValueError(f"maxsize must be at least {-(-needed // 1024)} KB for {valid} page(s)")
+    spare = budget - PDF_MIN_PAGE_BYTES * valid
+    return [PDF_MIN_PAGE_BYTES + int(spare * p / total) if p else None for p in pixels] if total else []
+
+def map_bounded(pool, fn, items, window):
+    # Like pool.map, but at most window results are pending or held at once
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def pdf_num(x):
+    return (b'%.2f' % x).rstrip(b'0').rstrip(b'.')
+
+class PdfWriter:
+    # Minimal PDF writer: each page is a DCTDecode image XObject written out
+    # as soon as it is added; the page tree and xref follow on close()
+    def __init__(self, fp):
+        self.fp = fp
+        self.offsets = {}
+        self.pages = []
+        self.next_num = 3  # 1 is the catalog, 2 the page tree
+        fp.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write_obj(self, num, body, stream=None):
+        self.offsets[num] = self.fp.tell()
+        self.fp.write(b'%d 0 obj\n' % num + body)
+        if stream is not None:
+            self.fp.write(b'\nstream\n' + stream + b'\nendstream')
+        self.fp.write(b'\nendobj\n')
+
+    def _add_obj(self, body, stream=None):
+        num = self.next_num
+        self.next_num += 1
+        self._write_obj(num, body, stream)
+        return num
+
+    def add_jpeg_page(self, jpeg, size, mode='RGB', layout_size=None, dpi=72):
+        # layout_size is the pixel size the page is measured at, for images
+        # that were downscaled to fit a byte budget
+        w, h = size
+        colorspace = b'/DeviceGray' if mode == 'L' else b'/DeviceRGB'
+        image = self._add_obj(
+            b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s '
+            b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>' % (w, h, colorspace, len(jpeg)), jpeg)
+        lw, lh = layout_size or size
+        pw, ph = pdf_num(lw * 72 / dpi), pdf_num(lh * 72 / dpi)
+        content = b'q %s 0 0 %s 0 0 cm /Im0 Do Q' % (pw, ph)
+        contents = self._add_obj(b'<< /Length %d >>' % len(content), content)
+        self.pages.append(self._add_obj(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] '
+            b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>' % (pw, ph, image, contents)))
+
+    def close(self):
+        kids = b' '.join(b'%d 0 R' % num for num in self.pages)
+        self._write_obj(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.pages)))
+        self._write_obj(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        xref = self.fp.tell()
+        self.fp.write(b'xref\n0 %d\n0000000000 65535 f \n' % self.next_num)
+        for num in range(1, self.next_num):
+            self.fp.write(b'%010d 00000 n \n' % self.offsets[num])
+        self.fp.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (self.next_num, xref))
+
+def pdf_params(form):
+    dpi, max_side = int(form.get('dpi', 72)), int(form.get('maxside', 0))
+    if dpi <= 0:
+        raise ValueError("dpi must be positive")
+    if max_side < 0:
+        raise ValueError("maxside must be positive, or 0 for no limit")
+    return dpi, max_side or None, size_target(form, 'maxsize', 0, optional=True)
+
+def check_pdf_maxsize(uploads, dpi=72, max_side=None, maxsize=0):
+    if maxsize:
+        page_budgets(uploads, maxsize, max_side)
+
+def build_pdf(uploads, dpi=72, max_side=None, maxsize=0):
+    # Returns a spooled buffer holding the PDF, or None if no page was usable
+    if maxsize:
+        budgets = page_budgets(uploads, maxsize, max_side)
+        pages = [(raw, b) for raw, b in zip(uploads, budgets) if b]
+    else:
+        pages = [(raw, None) for raw in uploads]
+    out = spooled_buffer()
+    pdf = PdfWriter(out)
+    encode = lambda page: encode_page(page[0], max_side, page[1])
+    for page in map_bounded(page_pool, encode, pages, PDF_WORKERS * 2):
+        if page is not None:
+            pdf.add_jpeg_page(*page, dpi=dpi)
+    if not pdf.pages:
+        out.close()
+        return None
+    pdf.close()
+    return out
+
+# Single-image operations, shared by their own routes and /batch: a form
+# parser and the pipeline stages for the parsed parameters
+# preview=1 on /passport and /signature trades quality for latency: bilinear
+# resampling after the reduced decode and one fixed-quality encode without
+# Huffman optimization, returned as *_preview.jpg with an X-Preview header
+PREVIEW_QUALITY = 80
+
+def is_preview(form):
+    return form.get('preview') == '1'
+
+def size_target(form, name, default, optional=False):
+    # A size target in KB from the form, in bytes; optional ones take 0 for
+    # no limit
+    kb = int(form.get(name, default))
+    if kb < 0 or (kb == 0 and not optional):
+        raise ValueError(f"{name} must be positive" + (", or 0 for no limit" if optional else ""))
+    return kb * 1024
+
+def output_size(form, width, height):
+    size = int(form.get('width', width)), int(form.get('height', height))
+    if min(size) <= 0:
+        raise ValueError("width and height must be positive")
+    return size
+
+# Auto-crop (autocrop=0 turns it off) decodes at up to FACE_DRAFT_SCALE times
+# the output size, so a crop down to that fraction of the frame keeps detail.
+FACE_DRAFT_SCALE = 2
+
+def passport_params(form):
+    return output_size(form, 200, 230) + (size_target(form, 'maxsize', 100), is_preview(form),
+                                          form.get('autocrop', '1') != '0')
+
+def passport_stages(width, height, maxsize, preview=False, autocrop=True):
+    stages = [('open', 'passport')]
+    if autocrop:
+        stages = [('open', 'passport', (width * FACE_DRAFT_SCALE, height * FACE_DRAFT_SCALE)),
+                  ('face_crop', (width, height))]
+    if preview:
+        return stages + [('resize', (width, height), Image.BILINEAR), ('rgb',), ('preview', PREVIEW_QUALITY)]
+    return stages + [('resize', (width, height)), ('rgb',), ('fit', maxsize)]
+
+def compress_params(form):
+    fmt = form.get('format', 'jpeg')
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    return size_target(form, 'targetsize', 50), fmt
+
+def compress_stages(targetsize, fmt='jpeg'):
+    if fmt == 'jpeg':
+        return [('open', 'compress'), ('rgb',), ('fit_scaled', targetsize)]
+    return [('open', 'compress'), ('color',), ('fit_format', targetsize, fmt)]
+
+def compress_lossless(raw, targetsize, fmt):
+    # A JPEG that fits once its metadata is stripped needs no re-encode: it
+    # goes back without the metadata, with its orientation applied by
+    # jpegtran, or without jpegtran, with the orientation as its only tag
+    if fmt not in ('jpeg', 'auto'):
+        return None
+    orientation = jpeg_orientation(raw, 'compress')
+    if orientation is None:
+        return None
+    if orientation in ORIENTATION_TRANSPOSES:
+        data = lossless_transpose(raw, 'compress')
+        if data is None or len(data) > targetsize:
+            data = strip_jpeg_metadata(raw, orientation)
+    else:
+        data = strip_jpeg_metadata(raw)
+    return data if data is not None and len(data) <= targetsize else None
+
+# Cleanup (clean=1, with mode=color|gray|bw) trims the frame, so like the
+# passport auto-crop it decodes at a multiple of the output size.
+SIGNATURE_DRAFT_SCALE = 4
+
+def signature_params(form):
+    mode = form.get('mode', 'color')
+    if mode not in SIGNATURE_MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    clean = form.get('clean') == '1'
+    return output_size(form, 140, 60) + (size_target(form, 'maxsize', 50), is_preview(form),
+                                         mode if clean else None)
+
+def signature_stages(width, height, maxsize, preview=False, clean=None):
+    stages = [('open', 'signature'), ('flatten',)]
+    if clean:
+        stages = [('open', 'signature', (width * SIGNATURE_DRAFT_SCALE, height * SIGNATURE_DRAFT_SCALE)),
+                  ('flatten',), ('clean_signature', clean, (width, height))]
+    if preview:
+        return stages + [('resize', (width, height), Image.BILINEAR), ('preview', PREVIEW_QUALITY)]
+    return stages + [('resize', (width, height)), ('fit', maxsize)]
+
+# /crop, /rotate and /filter replace the canvas exports of their tabs. Output
+# is JPEG (format=png for PNG), size-targeted when maxsize is given. JPEG
+# uploads are cropped or rotated losslessly where jpegtran allows it.
+def edit_params(form):
+    fmt = form.get('format', 'jpeg')
+    if fmt not in ('jpeg', 'png'):
+        raise ValueError(f"Unknown format: {fmt}")
+    return size_target(form, 'maxsize', 0, optional=True), fmt
+
+def edit_stages(route, edit, maxsize, fmt):
+    stages = [('open', route)] + edit
+    if fmt == 'png':
+        return stages + [('color',), ('fit_format', maxsize, 'png') if maxsize else ('png',)]
+    return stages + [('flatten',), ('fit_scaled', maxsize) if maxsize else ('encode', JPEG_QMAX)]
+
+def lossless_result(data, maxsize, fmt):
+    if data is None or fmt != 'jpeg' or (maxsize and len(data) > maxsize):
+        return None
+    return data
+
+def crop_params(form):
+    keys = ('x', 'y', 'width', 'height')
+    if any(k not in form for k in keys):
+        raise ValueError("x, y, width and height are required")
+    box = tuple(int(form[k]) for k in keys)
+    if min(box[2:]) <= 0:
+        raise ValueError("width and height must be positive")
+    return (box, form.get('snap') == '1') + edit_params(form)
+
+def crop_stages(box, snap, maxsize, fmt):
+    return edit_stages('crop', [('crop', box)], maxsize, fmt)
+
+def crop_lossless(raw, box, snap, maxsize, fmt):
+    return lossless_result(lossless_crop(raw, 'crop', box, snap) if fmt == 'jpeg' else None, maxsize, fmt)
+
+def rotate_params(form):
+    rotate = int(form.get('rotate', 0)) % 360
+    if rotate % 90:
+        raise ValueError("rotate must be a multiple of 90")
+    return (rotate, form.get('flip', '')) + edit_params(form)
+
+def rotate_stages(rotate, flip, maxsize, fmt):
+    method = compose_transposes(user_transposes(rotate, flip))
+    return edit_stages('rotate', [('transpose', method)] if method is not None else [], maxsize, fmt)
+
+def rotate_lossless(raw, rotate, flip, maxsize, fmt):
+    data = lossless_transpose(raw, 'rotate', user_transposes(rotate, flip)) if fmt == 'jpeg' else None
+    return lossless_result(data, maxsize, fmt)
+
+def filter_params(form):
+    name = form.get('filter', 'none')
+    if name not in FILTERS:
+        raise ValueError(f"Unknown filter: {name}")
+    return (name,) + edit_params(form)
+
+def filter_stages(name, maxsize, fmt):
+    return edit_stages('filter', [('filter', name)], maxsize, fmt)
+
+# name -> (form parser, stage builder, download name, optional fast path that
+# gets the same parameters and returns the result bytes or None to fall back)
+SINGLE_OPS = {
+    'passport': (passport_params, passport_stages, 'passport_photo.jpg', None),
+    'compress': (compress_params, compress_stages, 'compressed.jpg', compress_lossless),
+    'signature': (signature_params, signature_stages, 'signature.jpg', None),
+    'crop': (crop_params, crop_stages, 'cropped.jpg', crop_lossless),
+    'rotate': (rotate_params, rotate_stages, 'rotated.jpg', rotate_lossless),
+    'filter': (filter_params, filter_stages, 'filtered.jpg', None),
+}
 
-# Complete HTML with all JavaScript
-HTML = """<!doctype html>
-<html>
-<head>
-<meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
-<title>ImageMaster Pro - Government Job Tools</title>
-<script src="https://cdn.tailwindcss.com"></script>
-<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-<script src="https://cdn.jsdelivr.net/npm/sortablejs@1.15.0/Sortable.min.js"></script>
-<style>
+def run_single(op, raw, form):
+    parse, stages, _, fast = SINGLE_OPS[op]
+    params = parse(form)
+    key = result_cache.key(raw, op, *params)
+    data = result_cache.get(key)
+    if data is None and fast:
+        data = fast(raw, *params)
+        if data is not None:
+            count('fast_paths')
+            result_cache.put(key, data)
+    if data is None:
+        result = process_upload(raw, stages(*params))
+        if result is None:
+            return None
+        data = result[0]
+        result_cache.put(key, data)
+    return data
+
+def single_route(op):
+    f = request.files.get('image')
+    if not f: return "No file", 400
+    if not allowed_filename(f.filename): return "Invalid type", 400
+    try:
+        SINGLE_OPS[op][0](request.form)
+    except ValueError as e:
+        return f"Invalid parameters: {e}", 400
+    data = run_single(op, f.stream.read(), request.form)
+    if data is None: return "Invalid image", 400
+    name = output_name(SINGLE_OPS[op][2], data)
+    if op in ('passport', 'signature') and is_preview(request.form):
+        response = send_buffer(io.BytesIO(data), name.replace('.jpg', '_preview.jpg'))
+        response.headers['X-Preview'] = '1'
+        return response
+    return send_buffer(io.BytesIO(data), name)
+
+# /batch runs single-image operations on its own pool and streams a ZIP back
+# in completion order
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+class ZipSink:
+    # Write-only file for zipfile; having no tell() makes zipfile stream
+    # members with data descriptors instead of seeking back
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def form_value(v):
+    # JSON override values as the form would carry them
+    if isinstance(v, bool):
+        return '1' if v else '0'
+    return '' if v is None else str(v)
+
+def batch_forms(form, n):
+    # Shared parameters come from the form, per-file overrides from a JSON
+    # list in 'params' aligned with the files; None if 'params' is malformed
+    try:
+        overrides = json.loads(form.get('params') or '[]')
+    except ValueError:
+        return None
+    if not isinstance(overrides, list) or not all(isinstance(o, dict) for o in overrides):
+        return None
+    shared = form.to_dict()
+    return [dict(shared, **{k: form_value(v) for k, v in (overrides[i] if i < len(overrides) else {}).items()})
+            for i in range(n)]
+
+def run_batch_item(op, raw, form):
+    try:
+        return run_single(op, raw, form), None
+    except Exception as e:
+        traceback.print_exc()
+        return None, str(e)
+
+def stream_batch(op, items):
+    # items: (archive stem, upload bytes or None if rejected, form, rejection reason)
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        futures = {}
+        for stem, raw, form, error in items:
+            if raw is None:
+                zf.writestr(stem + '.error.txt', error)
+            else:
+                futures[batch_pool.submit(run_batch_item, op, raw, form)] = stem
+        yield sink.drain()
+        for fut in as_completed(futures):
+            stem = futures[fut]
+            data, error = fut.result()
+            if data is not None:
+                zf.writestr(output_name(stem, data), data)
+            else:
+                zf.writestr(stem + '.error.txt', error or 'Invalid image')
+            yield sink.drain()
+    yield sink.drain()
+
+# Job mode: POST /jobs/<op> queues the work and returns an id, GET /jobs/<id>
+# polls for the result (long-polls with ?wait=seconds). Jobs run on a local
+# thread pool; JOB_QUEUE_DEPTH bounds queued plus running jobs, and a full
+# queue answers 429. Finished jobs are kept for JOB_TTL seconds, a result only
+# until it is fetched, and once results hold more than JOB_RESULT_MB the oldest
+# are dropped.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', 16))
+JOB_TTL = int(os.environ.get('JOB_TTL', 600))
+JOB_RESULT_BYTES = int(os.environ.get('JOB_RESULT_MB', 64)) * 1024 * 1024
+JOB_MAX_WAIT = 30
+
+class Job:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.result = self.error = None
+        self.finished = None
+        self.done = threading.Event()
+
+class JobQueue:
+    def __init__(self, workers, depth, ttl, max_bytes):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.slots = threading.BoundedSemaphore(depth)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.result_bytes = 0
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        # fn returns (bytes, download name) or raises; None if the queue is full
+        if not self.slots.acquire(blocking=False):
+            return None
+        job = Job()
+        with self.lock:
+            self._expire()
+            self.jobs[job.id] = job
+        self.pool.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def take(self, job):
+        # A done job's result, handed out once
+        with self.lock:
+            result = job.result
+            return result if self._drop(job) else None
+
+    def status_counts(self):
+        counts = dict.fromkeys(('queued', 'running', 'done', 'failed'), 0)
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _run(self, job, fn, args):
+        job.status = 'running'
+        result = error = None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            traceback.print_exc()
+            error = str(e)
+        finally:
+            with self.lock:
+                job.result, job.error = result, error
+                job.status = 'failed' if result is None else 'done'
+                job.finished = time.time()
+                if result is not None:
+                    self.result_bytes += len(result[0])
+                self._expire()
+            self.slots.release()
+            job.done.set()
+
+    def _expire(self):
+        # Jobs past the TTL, then the oldest results while they hold more than
+        # max_bytes; the newest is kept even if it alone is over
+        cutoff = time.time() - self.ttl
+        finished = sorted((j for j in self.jobs.values() if j.finished), key=lambda j: j.finished)
+        for job in finished:
+            if job.finished < cutoff or (self.result_bytes > self.max_bytes and job is not finished[-1]):
+                self._drop(job)
+
+    def _drop(self, job):
+        if self.jobs.pop(job.id, None) is None:
+            return False
+        if job.result is not None:
+            self.result_bytes -= len(job.result[0])
+            job.result = None
+        return True
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_DEPTH, JOB_TTL, JOB_RESULT_BYTES)
+
+# Admission control. Each processing request is charged an estimate of the
+# memory its decodes need, ADMISSION_BYTES_PER_PIXEL per pixel of the uploads
+# it works on at once (header dimensions from UploadSpool, scaled to the size
+# the route's pipeline decodes them at), against a global budget of
+# ADMISSION_BUDGET_MB. Requests that don't fit wait in arrival order for up to
+# ADMISSION_WAIT seconds, and are turned away with 503 when that runs out or
+# ADMISSION_QUEUE are already waiting. Jobs wait in their worker for as long as it takes.
+ADMISSION_BUDGET = int(os.environ.get('ADMISSION_BUDGET_MB', 256)) * 1024 * 1024
+ADMISSION_QUEUE = int(os.environ.get('ADMISSION_QUEUE', 32))
+ADMISSION_WAIT = float(os.environ.get('ADMISSION_WAIT', 20))
+ADMISSION_BYTES_PER_PIXEL = 8   # decoded image plus one working copy
+
+class Admission:
+    def __init__(self, budget, max_queue):
+        self.budget = budget
+        self.max_queue = max_queue
+        self.in_use = 0
+        self.queue = deque()
+        self.rejected = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, cost, timeout=None):
+        # True once cost fits; a cost over the whole budget runs alone. With a
+        # timeout, False if it passes first or the queue is full
+        cost = min(cost, self.budget)
+        with self.cond:
+            must_wait = self.queue or self.in_use + cost > self.budget
+            if must_wait and timeout is not None and len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                return False
+            ticket = object()
+            self.queue.append(ticket)
+            try:
+                fits = self.cond.wait_for(lambda: self.queue[0] is ticket and self.in_use + cost <= self.budget, timeout)
+            finally:
+                self.queue.remove(ticket)
+                self.cond.notify_all()
+            if not fits:
+                self.rejected += 1
+                return False
+            self.in_use += cost
+            return True
+
+    def release(self, cost):
+        with self.cond:
+            self.in_use -= min(cost, self.budget)
+            self.cond.notify_all()
+
+admission = Admission(ADMISSION_BUDGET, ADMISSION_QUEUE)
+
+def open_hint(route, form):
+    # The draft/reduce size plan() gives the route's 'open' stage, or None
+    try:
+        if route == 'to_pdf':
+            stages = page_stages(*pdf_params(form)[1:])
+        else:
+            parse, build = SINGLE_OPS[route][:2]
+            stages = build(*parse(form))
+    except (KeyError, ValueError):
+        return None
+    stage = plan(stages)[0]
+    return stage[2] if len(stage) > 2 else None
+
+def decoded_pixels(fmt, size, hint):
+    # Pixels open_image decodes for an upload with this header. JPEGs come out
+    # of draft() at up to 1/8 scale (taking the orientation that scales
+    # least, as EXIF is not read here); anything else decodes in full
+    w, h = size
+    if not hint or fmt != 'JPEG':
+        return w * h
+    a, b = hint
+    ratio = min(w // a, h // b, w // b, h // a)
+    scale = 8 if ratio >= 8 else 4 if ratio >= 4 else 2 if ratio >= 2 else 1
+    return -(-w // scale) * -(-h // scale)
+
+def request_cost():
+    # Charged for as many of the largest decodes as the route runs at once
+    if request.endpoint == 'batch':
+        route, parallel = request.form.get('op'), BATCH_WORKERS
+        files = request.files.getlist('files')
+        forms = batch_forms(request.form, len(files)) or [request.form] * len(files)
+    else:
+        route = request.view_args.get('op', request.endpoint)
+        parallel = PDF_WORKERS if route == 'to_pdf' else 1
+        files = [f for _, f in request.files.items(multi=True)]
+        forms = [request.form] * len(files)
+    pixels = sorted((decoded_pixels(f.stream.format, f.stream.size, open_hint(route, form))
+                     for f, form in zip(files, forms) if upload_error(f, route) is None and f.stream.size), reverse=True)
+    return sum(pixels[:parallel]) * ADMISSION_BYTES_PER_PIXEL
+
+def admitted(view):
+    # Hold the request's cost while the view runs, or for /batch, which does
+    # its work while the zip streams out, until the response is closed
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cost = request_cost()
+        with timed('admission'):
+            if not admission.acquire(cost, ADMISSION_WAIT):
+                return "Server busy, try again shortly", 503, {'Retry-After': '5'}
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            admission.release(cost)
+            raise
+        if response.is_streamed and not response.direct_passthrough:
+            response.call_on_close(lambda: admission.release(cost))
+        else:
+            admission.release(cost)
+        return response
+    return wrapper
+
+def run_admitted(cost, fn, *args):
+    admission.acquire(cost)
+    try:
+        return fn(*args)
+    finally:
+        admission.release(cost)
+
+def single_job(op, raw, form):
+    data = run_single(op, raw, form)
+    if data is None:
+        raise ValueError("Invalid image")
+    return data, output_name(SINGLE_OPS[op][2], data)
+
+def pdf_job(uploads, params):
+    out = build_pdf(uploads, *params)
+    if out is None:
+        raise ValueError("No valid images")
+    with out:
+        out.seek(0)
+        return out.read(), 'document.pdf'
+
+# Page assets. The shell (HTML) is rendered once at import and served from
+# memory along with a stylesheet and one script per tab. The stylesheet holds
+# the page's own rules plus the Tailwind utilities it uses, precompiled, so
+# browsers no longer run Tailwind's CDN build. A tab's script loads the first
+# time the tab is shown.
+CSS = """*,::before,::after{box-sizing:border-box;border:0 solid #e5e7eb}
+html{line-height:1.5;-webkit-text-size-adjust:100%;tab-size:4;font-family:ui-sans-serif,system-ui,-apple-system,"Segoe UI",Roboto,"Helvetica Neue",Arial,sans-serif}
+body{margin:0;line-height:inherit}
+h1,h2,h3,p{margin:0}
+h1,h2,h3{font-size:inherit;font-weight:inherit}
+button,input,select{font-family:inherit;font-size:100%;font-weight:inherit;line-height:inherit;color:inherit;margin:0;padding:0}
+button,select{text-transform:none}
+button,[type=button],[type=submit]{-webkit-appearance:button;background-color:transparent;background-image:none}
+button,[role=button]{cursor:pointer}
+img,canvas{display:block;vertical-align:middle}
+img{max-width:100%;height:auto}
+[hidden]{display:none}
 .tab{display:none}.tab.active{display:block}
 .preview-container{border:2px dashed #cbd5e1;border-radius:0.5rem;padding:2rem;text-align:center;background:#f8fafc;transition:all 0.3s}
 .preview-container:hover{border-color:#667eea;background:#f1f5f9}
@@ -68,332 +1825,131 @@ canvas{max-width:100%;height:auto;border-radius:0.5rem}
 .crop-handle.sw{bottom:-5px;left:-5px;cursor:sw-resize;}
 .crop-handle.se{bottom:-5px;right:-5px;cursor:se-resize;}
 .crop-container{position:relative;display:inline-block;margin:0 auto;}
-</style>
-</head>
-<body class="bg-gradient-to-br from-purple-50 via-blue-50 to-pink-50 min-h-screen p-4">
-<div class="max-w-6xl mx-auto">
-
-<!-- Header -->
-<div class="bg-white p-6 rounded-2xl shadow-lg mb-6">
-<h1 class="text-3xl font-bold mb-2" style="background:linear-gradient(135deg,#667eea,#764ba2);-webkit-background-clip:text;-webkit-text-fill-color:transparent">
-<i class="fas fa-briefcase mr-2"></i>ImageMaster Pro</h1>
-<p class="text-gray-600">Perfect Tools for Government Job Applications</p>
-</div>
+.block{display:block}.inline-block{display:inline-block}.flex{display:flex}.grid{display:grid}.hidden{display:none}
+.flex-1{flex:1 1 0%}.flex-wrap{flex-wrap:wrap}.gap-2{gap:.5rem}.gap-3{gap:.75rem}.gap-4{gap:1rem}
+.grid-cols-1{grid-template-columns:repeat(1,minmax(0,1fr))}.grid-cols-2{grid-template-columns:repeat(2,minmax(0,1fr))}.grid-cols-3{grid-template-columns:repeat(3,minmax(0,1fr))}
+.w-full{width:100%}.max-w-6xl{max-width:72rem}.min-h-screen{min-height:100vh}.mx-auto{margin-left:auto;margin-right:auto}
+.mb-2{margin-bottom:.5rem}.mb-4{margin-bottom:1rem}.mb-6{margin-bottom:1.5rem}.mr-2{margin-right:.5rem}
+.mt-1{margin-top:.25rem}.mt-2{margin-top:.5rem}.mt-6{margin-top:1.5rem}.mt-8{margin-top:2rem}
+.p-4{padding:1rem}.p-6{padding:1.5rem}.p-8{padding:2rem}
+.px-4{padding-left:1rem;padding-right:1rem}.px-6{padding-left:1.5rem;padding-right:1.5rem}.px-8{padding-left:2rem;padding-right:2rem}
+.py-2{padding-top:.5rem;padding-bottom:.5rem}.py-3{padding-top:.75rem;padding-bottom:.75rem}
+.overflow-x-auto{overflow-x:auto}.cursor-pointer{cursor:pointer}
+.rounded-lg{border-radius:.5rem}.rounded-2xl{border-radius:1rem}
+.border{border-width:1px}.border-l-4{border-left-width:4px}
+.border-blue-500{border-color:#3b82f6}.border-green-200{border-color:#bbf7d0}.border-red-200{border-color:#fecaca}
+.bg-white{background-color:#fff}.bg-blue-50{background-color:#eff6ff}.bg-gray-500{background-color:#6b7280}
+.bg-green-50{background-color:#f0fdf4}.bg-green-500{background-color:#22c55e}.bg-red-50{background-color:#fef2f2}
+.hover\\:bg-green-600:hover{background-color:#16a34a}
+.bg-gradient-to-r{background-image:linear-gradient(to right,var(--tw-gradient-stops))}
+.bg-gradient-to-br{background-image:linear-gradient(to bottom right,var(--tw-gradient-stops))}
+.from-purple-50{--tw-gradient-from:#faf5ff;--tw-gradient-to:rgb(250 245 255/0);--tw-gradient-stops:var(--tw-gradient-from),var(--tw-gradient-to)}
+.via-blue-50{--tw-gradient-to:rgb(239 246 255/0);--tw-gradient-stops:var(--tw-gradient-from),#eff6ff,var(--tw-gradient-to)}
+.to-blue-50{--tw-gradient-to:#eff6ff}.to-pink-50{--tw-gradient-to:#fdf2f8}
+.shadow-lg{box-shadow:0 10px 15px -3px rgb(0 0 0/.1),0 4px 6px -4px rgb(0 0 0/.1)}
+.text-center{text-align:center}.font-medium{font-weight:500}.font-bold{font-weight:700}
+.text-xs{font-size:.75rem;line-height:1rem}.text-sm{font-size:.875rem;line-height:1.25rem}.text-lg{font-size:1.125rem;line-height:1.75rem}
+.text-xl{font-size:1.25rem;line-height:1.75rem}.text-2xl{font-size:1.5rem;line-height:2rem}.text-3xl{font-size:1.875rem;line-height:2.25rem}
+.text-6xl{font-size:3.75rem;line-height:1}
+.text-white{color:#fff}.text-blue-500{color:#3b82f6}.text-gray-400{color:#9ca3af}.text-gray-600{color:#4b5563}
+.text-green-600{color:#16a34a}.text-green-700{color:#15803d}.text-purple-600{color:#9333ea}.text-red-500{color:#ef4444}.text-red-700{color:#b91c1c}
+@media (min-width:768px){.md\\:grid-cols-4{grid-template-columns:repeat(4,minmax(0,1fr))}.md\\:grid-cols-5{grid-template-columns:repeat(5,minmax(0,1fr))}.md\\:grid-cols-6{grid-template-columns:repeat(6,minmax(0,1fr))}}
+"""
 
-<!-- Alert -->
-<div class="bg-blue-50 border-l-4 border-blue-500 p-4 mb-6 rounded-lg">
-<p class="text-sm"><i class="fas fa-info-circle text-blue-500"></i> <strong>For Government Job Applicants:</strong> Meet exact photo requirements for UPSC, SSC, Railway, Banking exams</p>
-</div>
+TAB_SCRIPTS = {
+'passport': """function selectPreset(btn,w,h){
+document.querySelectorAll('#passport .preset-btn').forEach(b=>b.classList.remove('active'));
+btn.classList.add('active');
+document.getElementById('passport-width').value=w;
+document.getElementById('passport-height').value=h;
+}
 
-<!-- Tabs -->
-<div class="bg-white p-4 rounded-2xl shadow-lg mb-6 overflow-x-auto">
-<div class="flex gap-2 flex-wrap">
-<button onclick="showTab('passport')" class="tab-button active px-6 py-3 rounded-lg"><i class="fas fa-id-card"></i> Passport</button>
-<button onclick="showTab('compress')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-compress"></i> Compress</button>
-<button onclick="showTab('crop')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-crop"></i> Crop</button>
-<button onclick="showTab('rotate')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-sync"></i> Rotate</button>
-<button onclick="showTab('filter')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-palette"></i> Filters</button>
-<button onclick="showTab('pdf')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-file-pdf"></i> PDF</button>
-<button onclick="showTab('signature')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-signature"></i> Signature</button>
-</div>
-</div>
+async function handlePassport(e){
+e.preventDefault();
+const form=e.target;
+const formData=new FormData(form);
+const resultDiv=document.getElementById('passport-result');
+resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Creating passport photo...</p>';
+try{
+const response=await fetch('/passport',{method:'POST',body:formData});
+if(response.ok){
+const blob=await response.blob();
+const url=URL.createObjectURL(blob);
+const size=(blob.size/1024).toFixed(1);
+resultDiv.innerHTML=`<div class="bg-green-50 border border-green-200 rounded-lg p-4 mb-4"><i class="fas fa-check-circle text-green-600"></i> <span class="font-bold text-green-700">Success!</span> ${size}KB</div><div class="text-center"><img src="${url}" class="preview-image mx-auto mb-4"><button onclick="downloadFile('${url}','passport_photo.jpg')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download</button></div>`;
+}else{
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
+}
+}catch(err){
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
+}
+}
+""",
+'compress': """function setTarget(btn,kb){
+document.querySelectorAll('#compress .preset-btn').forEach(b=>b.classList.remove('active'));
+btn.classList.add('active');
+document.getElementById('target-slider').value=kb;
+document.getElementById('target-val').textContent=kb;
+}
 
-<!-- Content -->
-<div class="bg-white p-6 rounded-2xl shadow-lg">
+async function handleCompress(e){
+e.preventDefault();
+const form=e.target;
+const formData=new FormData(form);
+const resultDiv=document.getElementById('compress-result');
+resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Compressing...</p>';
+try{
+const response=await fetch('/compress',{method:'POST',body:formData});
+if(response.ok){
+const blob=await response.blob();
+const url=URL.createObjectURL(blob);
+const size=(blob.size/1024).toFixed(1);
+resultDiv.innerHTML=`<div class="bg-green-50 border border-green-200 rounded-lg p-4 mb-4"><i class="fas fa-check-circle text-green-600"></i> <span class="font-bold text-green-700">Success!</span> ${size}KB</div><div class="text-center"><img src="${url}" class="preview-image mx-auto mb-4"><button onclick="downloadFile('${url}','compressed.'+({'image/webp':'webp','image/png':'png'}[blob.type]||'jpg'))" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download</button></div>`;
+}else{
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
+}
+}catch(err){
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
+}
+}
+""",
+'crop': """let cropImg,cropRatio='1:1',cropArea={x:0,y:0,width:0,height:0};
+let isDragging=false,isResizing=false,resizeHandle=null,startX=0,startY=0;
 
-<!-- Passport Photo -->
-<div id="passport" class="tab active">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-id-card text-purple-600"></i> Passport Size Photo</h2>
-<form id="form-passport" onsubmit="handlePassport(event)">
-<div class="preview-container mb-4">
-<input type="file" id="passport-input" name="image" accept="image/*" required onchange="previewImage(this,'passport-preview')" class="hidden">
-<label for="passport-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Photo</p>
-</label>
-<div id="passport-preview"></div>
-</div>
-<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
-<button type="button" class="preset-btn active" onclick="selectPreset(this,200,230)"><div class="font-bold">Standard</div><div class="text-xs">200×230px</div></button>
-<button type="button" class="preset-btn" onclick="selectPreset(this,300,350)"><div class="font-bold">UPSC</div><div class="text-xs">300×350px</div></button>
-<button type="button" class="preset-btn" onclick="selectPreset(this,240,320)"><div class="font-bold">SSC</div><div class="text-xs">240×320px</div></button>
-<button type="button" class="preset-btn" onclick="selectPreset(this,160,200)"><div class="font-bold">Banking</div><div class="text-xs">160×200px</div></button>
-</div>
-<div class="grid grid-cols-1 md:grid-cols-3 gap-4 mb-4">
-<div><label class="block text-sm font-medium mb-2">Width:</label>
-<input id="passport-width" name="width" type="number" value="200" min="50" required class="w-full px-4 py-2 border rounded-lg"></div>
-<div><label class="block text-sm font-medium mb-2">Height:</label>
-<input id="passport-height" name="height" type="number" value="230" min="50" required class="w-full px-4 py-2 border rounded-lg"></div>
-<div><label class="block text-sm font-medium mb-2">Max Size:</label>
-<select name="maxsize" class="w-full px-4 py-2 border rounded-lg">
-<option value="50">50 KB</option><option value="100" selected>100 KB</option><option value="200">200 KB</option></select></div>
-</div>
-<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-magic mr-2"></i>Create Passport Photo</button>
-</form>
-<div id="passport-result" class="mt-6"></div>
-</div>
+// Crop - Fixed Implementation
+function loadCrop(input){
+if(input.files&&input.files[0]){
+const reader=new FileReader();
+reader.onload=function(e){
+cropImg=new Image();
+cropImg.onload=function(){
+document.getElementById('crop-container').style.display='block';
+document.getElementById('crop-image').src=e.target.result;
+document.getElementById('original-preview').innerHTML=`<img src="${e.target.result}" class="preview-image" style="max-height:200px">`;
+initCropArea();
+};
+cropImg.src=e.target.result;
+};
+reader.readAsDataURL(input.files[0]);
+}
+}
 
-<!-- Compress -->
-<div id="compress" class="tab">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-compress text-purple-600"></i> Compress to Size</h2>
-<form id="form-compress" onsubmit="handleCompress(event)">
-<div class="preview-container mb-4">
-<input type="file" id="compress-input" name="image" accept="image/*" required onchange="previewImage(this,'compress-preview')" class="hidden">
-<label for="compress-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Image</p>
-</label>
-<div id="compress-preview"></div>
-</div>
-<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
-<button type="button" class="preset-btn" onclick="setTarget(20)">20 KB</button>
-<button type="button" class="preset-btn active" onclick="setTarget(50)">50 KB</button>
-<button type="button" class="preset-btn" onclick="setTarget(100)">100 KB</button>
-<button type="button" class="preset-btn" onclick="setTarget(200)">200 KB</button>
-</div>
-<div class="mb-4">
-<label class="block text-sm font-medium mb-2">Target: <span id="target-val" class="text-purple-600 font-bold">50</span> KB</label>
-<input name="targetsize" id="target-slider" type="range" value="50" min="10" max="500" step="10" oninput="document.getElementById('target-val').textContent=this.value" class="w-full">
-</div>
-<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-compress mr-2"></i>Compress</button>
-</form>
-<div id="compress-result" class="mt-6"></div>
-</div>
+function setCropRatio(btn,ratio){
+document.querySelectorAll('#crop .preset-btn').forEach(b=>b.classList.remove('active'));
+btn.classList.add('active');
+cropRatio=ratio;
+initCropArea();
+}
 
-<!-- Crop -->
-<div id="crop" class="tab">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-crop text-purple-600"></i> Crop Image</h2>
-<div class="preview-container mb-4">
-<input type="file" id="crop-input" accept="image/*" onchange="loadCrop(this)" class="hidden">
-<label for="crop-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Image</p>
-</label>
-</div>
-<div id="crop-container" style="display:none">
-<div class="grid grid-cols-3 md:grid-cols-6 gap-2 mb-4">
-<button type="button" class="preset-btn active" onclick="setCropRatio('1:1')">1:1</button>
-<button type="button" class="preset-btn" onclick="setCropRatio('4:3')">4:3</button>
-<button type="button" class="preset-btn" onclick="setCropRatio('16:9')">16:9</button>
-<button type="button" class="preset-btn" onclick="setCropRatio('3:4')">3:4</button>
-<button type="button" class="preset-btn" onclick="setCropRatio('9:16')">9:16</button>
-<button type="button" class="preset-btn" onclick="setCropRatio('free')">Free</button>
-</div>
-<div class="text-center mb-4">
-<div class="crop-container">
-<img id="crop-image" style="max-width:100%;max-height:500px;">
-<div id="crop-area" class="crop-area" style="display:none;">
-<div class="crop-handle nw"></div>
-<div class="crop-handle ne"></div>
-<div class="crop-handle sw"></div>
-<div class="crop-handle se"></div>
-</div>
-</div>
-</div>
-<div class="comparison-container mb-4">
-<div class="comparison-item">
-<h3 class="font-bold mb-2">Original</h3>
-<div id="original-preview"></div>
-</div>
-<div class="comparison-item">
-<h3 class="font-bold mb-2">Cropped</h3>
-<div id="cropped-preview"></div>
-</div>
-</div>
-<div class="flex gap-2">
-<button onclick="resetCrop()" class="flex-1 bg-gray-500 text-white px-6 py-3 rounded-lg"><i class="fas fa-undo mr-2"></i>Reset</button>
-<button onclick="downloadCrop()" class="flex-1 btn-primary text-white px-6 py-3 rounded-lg"><i class="fas fa-download mr-2"></i>Download</button>
-</div>
-</div>
-</div>
+function initCropArea(){
+const img=document.getElementById('crop-image');
+const container=img.parentElement;
+const area=document.getElementById('crop-area');
 
-<!-- Rotate -->
-<div id="rotate" class="tab">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-sync text-purple-600"></i> Rotate & Flip</h2>
-<div class="preview-container mb-4">
-<input type="file" id="rotate-input" accept="image/*" onchange="loadRotate(this)" class="hidden">
-<label for="rotate-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Image</p>
-</label>
-</div>
-<div id="rotate-container" style="display:none">
-<div class="text-center mb-4"><canvas id="rotate-canvas" class="mx-auto"></canvas></div>
-<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
-<button onclick="doRotate(90)" class="preset-btn"><i class="fas fa-redo"></i> 90°</button>
-<button onclick="doRotate(180)" class="preset-btn"><i class="fas fa-redo"></i> 180°</button>
-<button onclick="doFlip('h')" class="preset-btn"><i class="fas fa-arrows-alt-h"></i> Flip H</button>
-<button onclick="doFlip('v')" class="preset-btn"><i class="fas fa-arrows-alt-v"></i> Flip V</button>
-</div>
-<div class="flex gap-2">
-<button onclick="resetRotate()" class="flex-1 bg-gray-500 text-white px-6 py-3 rounded-lg"><i class="fas fa-undo mr-2"></i>Reset</button>
-<button onclick="downloadRotate()" class="flex-1 btn-primary text-white px-6 py-3 rounded-lg"><i class="fas fa-download mr-2"></i>Download</button>
-</div>
-</div>
-</div>
-
-<!-- Filter -->
-<div id="filter" class="tab">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-palette text-purple-600"></i> Filters</h2>
-<div class="preview-container mb-4">
-<input type="file" id="filter-input" accept="image/*" onchange="loadFilter(this)" class="hidden">
-<label for="filter-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Image</p>
-</label>
-</div>
-<div id="filter-container" style="display:none">
-<div class="text-center mb-4"><canvas id="filter-canvas" class="mx-auto"></canvas></div>
-<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
-<button onclick="applyFilter('none')" class="preset-btn active">Original</button>
-<button onclick="applyFilter('grayscale')" class="preset-btn">Grayscale</button>
-<button onclick="applyFilter('sepia')" class="preset-btn">Sepia</button>
-<button onclick="applyFilter('blur')" class="preset-btn">Blur</button>
-<button onclick="applyFilter('brightness')" class="preset-btn">Bright</button>
-<button onclick="applyFilter('contrast')" class="preset-btn">Contrast</button>
-<button onclick="applyFilter('saturate')" class="preset-btn">Vibrant</button>
-<button onclick="applyFilter('invert')" class="preset-btn">Invert</button>
-</div>
-<div class="flex gap-2">
-<button onclick="resetFilter()" class="flex-1 bg-gray-500 text-white px-6 py-3 rounded-lg"><i class="fas fa-undo mr-2"></i>Reset</button>
-<button onclick="downloadFilter()" class="flex-1 btn-primary text-white px-6 py-3 rounded-lg"><i class="fas fa-download mr-2"></i>Download</button>
-</div>
-</div>
-</div>
-
-<!-- PDF -->
-<div id="pdf" class="tab">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-file-pdf text-purple-600"></i> Images to PDF</h2>
-<form id="form-pdf" onsubmit="handlePDF(event)">
-<div class="preview-container mb-4">
-<input type="file" id="pdf-input" name="files" accept="image/*" multiple required onchange="handlePDFImages(this)" class="hidden">
-<label for="pdf-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Multiple Images</p>
-</label>
-</div>
-<div id="pdf-preview" class="grid grid-cols-2 md:grid-cols-4 gap-4 mb-4"></div>
-<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-file-pdf mr-2"></i>Create PDF</button>
-</form>
-<div id="pdf-result" class="mt-6"></div>
-</div>
-
-<!-- Signature -->
-<div id="signature" class="tab">
-<h2 class="text-2xl font-bold mb-4"><i class="fas fa-signature text-purple-600"></i> Signature Tool</h2>
-<form id="form-signature" onsubmit="handleSignature(event)">
-<div class="preview-container mb-4">
-<input type="file" id="signature-input" name="image" accept="image/*" required onchange="previewImage(this,'signature-preview')" class="hidden">
-<label for="signature-input" class="cursor-pointer inline-block">
-<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
-<p class="text-lg font-medium mt-2">Upload Signature</p>
-</label>
-<div id="signature-preview"></div>
-</div>
-<div class="grid grid-cols-1 md:grid-cols-3 gap-4 mb-4">
-<div><label class="block text-sm font-medium mb-2">Width:</label>
-<input name="width" type="number" value="140" min="50" required class="w-full px-4 py-2 border rounded-lg"></div>
-<div><label class="block text-sm font-medium mb-2">Height:</label>
-<input name="height" type="number" value="60" min="30" required class="w-full px-4 py-2 border rounded-lg"></div>
-<div><label class="block text-sm font-medium mb-2">Max Size:</label>
-<select name="maxsize" class="w-full px-4 py-2 border rounded-lg">
-<option value="20">20 KB</option><option value="50" selected>50 KB</option><option value="100">100 KB</option></select></div>
-</div>
-<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-magic mr-2"></i>Process Signature</button>
-</form>
-<div id="signature-result" class="mt-6"></div>
-</div>
-
-</div>
-
-<!-- Footer -->
-<div class="mt-8 text-center text-sm text-gray-600">
-<p>© 2024 ImageMaster Pro • Perfect for Government Job Applications</p>
-</div>
-
-</div>
-
-<script>
-let pdfImages=[],sortable=null;
-let cropImg,cropRatio='1:1',cropArea={x:0,y:0,width:0,height:0};
-let rotateCanvas,rotateCtx,rotateImg,rotation=0,flippedH=false,flippedV=false;
-let filterCanvas,filterCtx,filterImg,currentFilter='none';
-let isDragging=false,isResizing=false,resizeHandle=null,startX=0,startY=0;
-
-function showTab(id){
-document.querySelectorAll('.tab').forEach(t=>t.classList.remove('active'));
-document.querySelectorAll('.tab-button').forEach(b=>b.classList.remove('active'));
-document.getElementById(id).classList.add('active');
-event.target.classList.add('active');
-['passport-result','compress-result','pdf-result','signature-result'].forEach(r=>{
-const el=document.getElementById(r);if(el)el.innerHTML='';
-});
-}
-
-function previewImage(input,previewId){
-const preview=document.getElementById(previewId);
-if(input.files&&input.files[0]){
-const reader=new FileReader();
-reader.onload=function(e){
-const img=new Image();
-img.onload=function(){
-const size=(input.files[0].size/1024).toFixed(1);
-preview.innerHTML=`<img src="${e.target.result}" class="preview-image"><p class="text-sm text-gray-600 mt-2"><i class="fas fa-info-circle"></i> ${img.width}×${img.height}px • ${size}KB</p>`;
-};
-img.src=e.target.result;
-};
-reader.readAsDataURL(input.files[0]);
-}
-}
-
-function selectPreset(btn,w,h){
-document.querySelectorAll('#passport .preset-btn').forEach(b=>b.classList.remove('active'));
-btn.classList.add('active');
-document.getElementById('passport-width').value=w;
-document.getElementById('passport-height').value=h;
-}
-
-function setTarget(kb){
-document.querySelectorAll('#compress .preset-btn').forEach(b=>b.classList.remove('active'));
-event.target.classList.add('active');
-document.getElementById('target-slider').value=kb;
-document.getElementById('target-val').textContent=kb;
-}
-
-// Crop - Fixed Implementation
-function loadCrop(input){
-if(input.files&&input.files[0]){
-const reader=new FileReader();
-reader.onload=function(e){
-cropImg=new Image();
-cropImg.onload=function(){
-document.getElementById('crop-container').style.display='block';
-document.getElementById('crop-image').src=e.target.result;
-document.getElementById('original-preview').innerHTML=`<img src="${e.target.result}" class="preview-image" style="max-height:200px">`;
-initCropArea();
-};
-cropImg.src=e.target.result;
-};
-reader.readAsDataURL(input.files[0]);
-}
-}
-
-function setCropRatio(ratio){
-document.querySelectorAll('#crop .preset-btn').forEach(b=>b.classList.remove('active'));
-event.target.classList.add('active');
-cropRatio=ratio;
-initCropArea();
-}
-
-function initCropArea(){
-const img=document.getElementById('crop-image');
-const container=img.parentElement;
-const area=document.getElementById('crop-area');
-
-// Calculate initial crop area
-let width,height;
-const imgWidth=img.offsetWidth;
-const imgHeight=img.offsetHeight;
+// Calculate initial crop area
+let width,height;
+const imgWidth=img.offsetWidth;
+const imgHeight=img.offsetHeight;
 
 if(cropRatio==='free'){
 width=imgWidth*0.7;
@@ -535,6 +2091,13 @@ initCropArea();
 
 function downloadCrop(){
 const img=document.getElementById('crop-image');
+const scaleX=img.naturalWidth/img.offsetWidth;
+const scaleY=img.naturalHeight/img.offsetHeight;
+downloadServer('/crop','crop-input',{x:Math.round(cropArea.x*scaleX),y:Math.round(cropArea.y*scaleY),width:Math.round(cropArea.width*scaleX),height:Math.round(cropArea.height*scaleY)},'cropped',cropCanvasDownload);
+}
+
+function cropCanvasDownload(){
+const img=document.getElementById('crop-image');
 const canvas=document.createElement('canvas');
 const ctx=canvas.getContext('2d');
 
@@ -554,6 +2117,8 @@ canvas.width,canvas.height
 
 downloadCanvas(canvas,'cropped');
 }
+""",
+'rotate': """let rotateCanvas,rotateCtx,rotateImg,rotation=0,flippedH=false,flippedV=false;
 
 // Rotate
 function loadRotate(input){
@@ -618,102 +2183,484 @@ drawRotate();
 
 function downloadRotate(){
 if(!rotateCanvas)return;
-downloadCanvas(rotateCanvas,'rotated');
+downloadServer('/rotate','rotate-input',{rotate:rotation,flip:(flippedH?'h':'')+(flippedV?'v':'')},'rotated',()=>downloadCanvas(rotateCanvas,'rotated'));
+}
+""",
+'filter': """let filterCanvas,filterCtx,filterImg,currentFilter='none';
+
+// Filter
+function loadFilter(input){
+if(input.files&&input.files[0]){
+const reader=new FileReader();
+reader.onload=function(e){
+filterImg=new Image();
+filterImg.onload=function(){
+filterCanvas=document.getElementById('filter-canvas');
+filterCtx=filterCanvas.getContext('2d');
+filterCanvas.width=filterImg.width;
+filterCanvas.height=filterImg.height;
+document.getElementById('filter-container').style.display='block';
+currentFilter='none';
+drawFilter();
+};
+filterImg.src=e.target.result;
+};
+reader.readAsDataURL(input.files[0]);
+}
+}
+
+function applyFilter(btn,filter){
+document.querySelectorAll('#filter .preset-btn').forEach(b=>b.classList.remove('active'));
+btn.classList.add('active');
+currentFilter=filter;
+drawFilter();
 }
 
-// Filter
-function loadFilter(input){
-if(input.files&&input.files[0]){
-const reader=new FileReader();
-reader.onload=function(e){
-filterImg=new Image();
-filterImg.onload=function(){
-filterCanvas=document.getElementById('filter-canvas');
-filterCtx=filterCanvas.getContext('2d');
-filterCanvas.width=filterImg.width;
-filterCanvas.height=filterImg.height;
-document.getElementById('filter-container').style.display='block';
-currentFilter='none';
-drawFilter();
-};
-filterImg.src=e.target.result;
-};
-reader.readAsDataURL(input.files[0]);
-}
-}
+function drawFilter(){
+if(!filterImg||!filterCanvas)return;
+filterCtx.clearRect(0,0,filterCanvas.width,filterCanvas.height);
+const filters={'none':'none','grayscale':'grayscale(100%)','sepia':'sepia(100%)','blur':'blur(3px)','brightness':'brightness(1.3)','contrast':'contrast(1.3)','saturate':'saturate(1.5)','invert':'invert(100%)'};
+filterCtx.filter=filters[currentFilter]||'none';
+filterCtx.drawImage(filterImg,0,0);
+filterCtx.filter='none';
+}
+
+function resetFilter(){
+currentFilter='none';
+document.querySelectorAll('#filter .preset-btn').forEach((b,i)=>{
+b.classList.remove('active');
+if(i===0)b.classList.add('active');
+});
+drawFilter();
+}
+
+function downloadFilter(){
+if(!filterCanvas)return;
+downloadServer('/filter','filter-input',{filter:currentFilter},'filtered',()=>downloadCanvas(filterCanvas,'filtered'));
+}
+""",
+'pdf': """let pdfImages=[],sortable=null;
+
+// Sortable is only needed here, so it loads with this tab
+const sortableReady=loadScript('https://cdn.jsdelivr.net/npm/sortablejs@1.15.0/Sortable.min.js');
+
+function handlePDFImages(input){
+pdfImages=Array.from(input.files);
+renderPDF();
+makeSortable();
+}
+
+function makeSortable(){
+if(sortable){sortable.destroy();sortable=null;}
+if(!pdfImages.length)return;
+sortableReady.then(()=>{
+if(sortable)sortable.destroy();
+sortable=Sortable.create(document.getElementById('pdf-preview'),{
+animation:150,
+onEnd:function(evt){
+const moved=pdfImages.splice(evt.oldIndex,1)[0];
+pdfImages.splice(evt.newIndex,0,moved);
+}
+});
+});
+}
+
+function renderPDF(){
+const preview=document.getElementById('pdf-preview');
+preview.innerHTML='';
+pdfImages.forEach((file,idx)=>{
+const reader=new FileReader();
+reader.onload=function(e){
+const div=document.createElement('div');
+div.className='pdf-image-item';
+div.innerHTML=`<img src="${e.target.result}"><div class="remove-btn" onclick="removePDF(${idx})">×</div><p class="text-xs text-gray-600 mt-1 text-center">${idx+1}</p>`;
+preview.appendChild(div);
+};
+reader.readAsDataURL(file);
+});
+}
+
+function removePDF(idx){
+pdfImages.splice(idx,1);
+renderPDF();
+makeSortable();
+}
+
+async function handlePDF(e){
+e.preventDefault();
+const form=e.target;
+const formData=new FormData(form);
+formData.delete('files');
+pdfImages.forEach(file=>formData.append('files',file));
+const resultDiv=document.getElementById('pdf-result');
+resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Creating PDF...</p>';
+try{
+const response=await fetch('/to_pdf',{method:'POST',body:formData});
+if(response.ok){
+const blob=await response.blob();
+const url=URL.createObjectURL(blob);
+resultDiv.innerHTML=`<div class="text-center bg-gradient-to-r from-purple-50 to-blue-50 p-8 rounded-lg"><i class="fas fa-file-pdf text-6xl text-red-500 mb-4"></i><h3 class="font-bold text-xl mb-2">PDF Created!</h3><p class="text-gray-600 mb-4">${pdfImages.length} images</p><button onclick="downloadFile('${url}','document.pdf')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download PDF</button></div>`;
+}else{
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
+}
+}catch(err){
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
+}
+}
+""",
+'signature': """async function handleSignature(e){
+e.preventDefault();
+const form=e.target;
+const formData=new FormData(form);
+const resultDiv=document.getElementById('signature-result');
+resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Processing...</p>';
+try{
+const response=await fetch('/signature',{method:'POST',body:formData});
+if(response.ok){
+const blob=await response.blob();
+const url=URL.createObjectURL(blob);
+const size=(blob.size/1024).toFixed(1);
+resultDiv.innerHTML=`<div class="bg-green-50 border border-green-200 rounded-lg p-4 mb-4"><i class="fas fa-check-circle text-green-600"></i> <span class="font-bold text-green-700">Success!</span> ${size}KB</div><div class="text-center"><div class="bg-white p-4 inline-block mb-4"><img src="${url}" class="preview-image mx-auto" style="max-height:150px"></div><br><button onclick="downloadFile('${url}','signature.jpg')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download</button></div>`;
+}else{
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
+}
+}catch(err){
+resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
+}
+}
+""",
+}
+
+HTML = """<!doctype html>
+<html>
+<head>
+<meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
+<title>ImageMaster Pro - Government Job Tools</title>
+<link rel="stylesheet" href="{{ stylesheet }}">
+<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+</head>
+<body class="bg-gradient-to-br from-purple-50 via-blue-50 to-pink-50 min-h-screen p-4">
+<div class="max-w-6xl mx-auto">
+
+<!-- Header -->
+<div class="bg-white p-6 rounded-2xl shadow-lg mb-6">
+<h1 class="text-3xl font-bold mb-2" style="background:linear-gradient(135deg,#667eea,#764ba2);-webkit-background-clip:text;-webkit-text-fill-color:transparent">
+<i class="fas fa-briefcase mr-2"></i>ImageMaster Pro</h1>
+<p class="text-gray-600">Perfect Tools for Government Job Applications</p>
+</div>
+
+<!-- Alert -->
+<div class="bg-blue-50 border-l-4 border-blue-500 p-4 mb-6 rounded-lg">
+<p class="text-sm"><i class="fas fa-info-circle text-blue-500"></i> <strong>For Government Job Applicants:</strong> Meet exact photo requirements for UPSC, SSC, Railway, Banking exams</p>
+</div>
+
+<!-- Tabs -->
+<div class="bg-white p-4 rounded-2xl shadow-lg mb-6 overflow-x-auto">
+<div class="flex gap-2 flex-wrap">
+<button onclick="showTab('passport')" class="tab-button active px-6 py-3 rounded-lg"><i class="fas fa-id-card"></i> Passport</button>
+<button onclick="showTab('compress')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-compress"></i> Compress</button>
+<button onclick="showTab('crop')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-crop"></i> Crop</button>
+<button onclick="showTab('rotate')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-sync"></i> Rotate</button>
+<button onclick="showTab('filter')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-palette"></i> Filters</button>
+<button onclick="showTab('pdf')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-file-pdf"></i> PDF</button>
+<button onclick="showTab('signature')" class="tab-button px-6 py-3 rounded-lg"><i class="fas fa-signature"></i> Signature</button>
+</div>
+</div>
+
+<!-- Content -->
+<div class="bg-white p-6 rounded-2xl shadow-lg">
+
+<!-- Passport Photo -->
+<div id="passport" class="tab active">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-id-card text-purple-600"></i> Passport Size Photo</h2>
+<form id="form-passport" onsubmit="act(event,'passport','handlePassport',event)">
+<div class="preview-container mb-4">
+<input type="file" id="passport-input" name="image" accept="image/*" required onchange="previewImage(this,'passport-preview')" class="hidden">
+<label for="passport-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Photo</p>
+</label>
+<div id="passport-preview"></div>
+</div>
+<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
+<button type="button" class="preset-btn active" onclick="act(event,'passport','selectPreset',this,200,230)"><div class="font-bold">Standard</div><div class="text-xs">200×230px</div></button>
+<button type="button" class="preset-btn" onclick="act(event,'passport','selectPreset',this,300,350)"><div class="font-bold">UPSC</div><div class="text-xs">300×350px</div></button>
+<button type="button" class="preset-btn" onclick="act(event,'passport','selectPreset',this,240,320)"><div class="font-bold">SSC</div><div class="text-xs">240×320px</div></button>
+<button type="button" class="preset-btn" onclick="act(event,'passport','selectPreset',this,160,200)"><div class="font-bold">Banking</div><div class="text-xs">160×200px</div></button>
+</div>
+<div class="grid grid-cols-1 md:grid-cols-4 gap-4 mb-4">
+<div><label class="block text-sm font-medium mb-2">Width:</label>
+<input id="passport-width" name="width" type="number" value="200" min="50" required class="w-full px-4 py-2 border rounded-lg"></div>
+<div><label class="block text-sm font-medium mb-2">Height:</label>
+<input id="passport-height" name="height" type="number" value="230" min="50" required class="w-full px-4 py-2 border rounded-lg"></div>
+<div><label class="block text-sm font-medium mb-2">Max Size:</label>
+<select name="maxsize" class="w-full px-4 py-2 border rounded-lg">
+<option value="50">50 KB</option><option value="100" selected>100 KB</option><option value="200">200 KB</option></select></div>
+<div><label class="block text-sm font-medium mb-2">Framing:</label>
+<select name="autocrop" class="w-full px-4 py-2 border rounded-lg">
+<option value="1" selected>Crop to face</option><option value="0">Whole image</option></select></div>
+</div>
+<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-magic mr-2"></i>Create Passport Photo</button>
+</form>
+<div id="passport-result" class="mt-6"></div>
+</div>
+
+<!-- Compress -->
+<div id="compress" class="tab">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-compress text-purple-600"></i> Compress to Size</h2>
+<form id="form-compress" onsubmit="act(event,'compress','handleCompress',event)">
+<div class="preview-container mb-4">
+<input type="file" id="compress-input" name="image" accept="image/*" required onchange="previewImage(this,'compress-preview')" class="hidden">
+<label for="compress-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Image</p>
+</label>
+<div id="compress-preview"></div>
+</div>
+<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
+<button type="button" class="preset-btn" onclick="act(event,'compress','setTarget',this,20)">20 KB</button>
+<button type="button" class="preset-btn active" onclick="act(event,'compress','setTarget',this,50)">50 KB</button>
+<button type="button" class="preset-btn" onclick="act(event,'compress','setTarget',this,100)">100 KB</button>
+<button type="button" class="preset-btn" onclick="act(event,'compress','setTarget',this,200)">200 KB</button>
+</div>
+<div class="mb-4">
+<label class="block text-sm font-medium mb-2">Target: <span id="target-val" class="text-purple-600 font-bold">50</span> KB</label>
+<input name="targetsize" id="target-slider" type="range" value="50" min="10" max="500" step="10" oninput="document.getElementById('target-val').textContent=this.value" class="w-full">
+</div>
+<div class="mb-4"><label class="block text-sm font-medium mb-2">Format:</label>
+<select name="format" class="w-full px-4 py-2 border rounded-lg">
+<option value="jpeg" selected>JPEG</option><option value="progressive">Progressive JPEG</option><option value="webp">WebP</option><option value="webp_lossless">WebP (lossless)</option><option value="png">PNG (palette)</option><option value="auto">Auto (best that fits)</option></select></div>
+<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-compress mr-2"></i>Compress</button>
+</form>
+<div id="compress-result" class="mt-6"></div>
+</div>
+
+<!-- Crop -->
+<div id="crop" class="tab">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-crop text-purple-600"></i> Crop Image</h2>
+<div class="preview-container mb-4">
+<input type="file" id="crop-input" accept="image/*" onchange="act(event,'crop','loadCrop',this)" class="hidden">
+<label for="crop-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Image</p>
+</label>
+</div>
+<div id="crop-container" style="display:none">
+<div class="grid grid-cols-3 md:grid-cols-6 gap-2 mb-4">
+<button type="button" class="preset-btn active" onclick="act(event,'crop','setCropRatio',this,'1:1')">1:1</button>
+<button type="button" class="preset-btn" onclick="act(event,'crop','setCropRatio',this,'4:3')">4:3</button>
+<button type="button" class="preset-btn" onclick="act(event,'crop','setCropRatio',this,'16:9')">16:9</button>
+<button type="button" class="preset-btn" onclick="act(event,'crop','setCropRatio',this,'3:4')">3:4</button>
+<button type="button" class="preset-btn" onclick="act(event,'crop','setCropRatio',this,'9:16')">9:16</button>
+<button type="button" class="preset-btn" onclick="act(event,'crop','setCropRatio',this,'free')">Free</button>
+</div>
+<div class="text-center mb-4">
+<div class="crop-container">
+<img id="crop-image" style="max-width:100%;max-height:500px;">
+<div id="crop-area" class="crop-area" style="display:none;">
+<div class="crop-handle nw"></div>
+<div class="crop-handle ne"></div>
+<div class="crop-handle sw"></div>
+<div class="crop-handle se"></div>
+</div>
+</div>
+</div>
+<div class="comparison-container mb-4">
+<div class="comparison-item">
+<h3 class="font-bold mb-2">Original</h3>
+<div id="original-preview"></div>
+</div>
+<div class="comparison-item">
+<h3 class="font-bold mb-2">Cropped</h3>
+<div id="cropped-preview"></div>
+</div>
+</div>
+<div class="flex gap-2">
+<button onclick="act(event,'crop','resetCrop')" class="flex-1 bg-gray-500 text-white px-6 py-3 rounded-lg"><i class="fas fa-undo mr-2"></i>Reset</button>
+<button onclick="act(event,'crop','downloadCrop')" class="flex-1 btn-primary text-white px-6 py-3 rounded-lg"><i class="fas fa-download mr-2"></i>Download</button>
+</div>
+</div>
+</div>
+
+<!-- Rotate -->
+<div id="rotate" class="tab">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-sync text-purple-600"></i> Rotate & Flip</h2>
+<div class="preview-container mb-4">
+<input type="file" id="rotate-input" accept="image/*" onchange="act(event,'rotate','loadRotate',this)" class="hidden">
+<label for="rotate-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Image</p>
+</label>
+</div>
+<div id="rotate-container" style="display:none">
+<div class="text-center mb-4"><canvas id="rotate-canvas" class="mx-auto"></canvas></div>
+<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
+<button onclick="act(event,'rotate','doRotate',90)" class="preset-btn"><i class="fas fa-redo"></i> 90°</button>
+<button onclick="act(event,'rotate','doRotate',180)" class="preset-btn"><i class="fas fa-redo"></i> 180°</button>
+<button onclick="act(event,'rotate','doFlip','h')" class="preset-btn"><i class="fas fa-arrows-alt-h"></i> Flip H</button>
+<button onclick="act(event,'rotate','doFlip','v')" class="preset-btn"><i class="fas fa-arrows-alt-v"></i> Flip V</button>
+</div>
+<div class="flex gap-2">
+<button onclick="act(event,'rotate','resetRotate')" class="flex-1 bg-gray-500 text-white px-6 py-3 rounded-lg"><i class="fas fa-undo mr-2"></i>Reset</button>
+<button onclick="act(event,'rotate','downloadRotate')" class="flex-1 btn-primary text-white px-6 py-3 rounded-lg"><i class="fas fa-download mr-2"></i>Download</button>
+</div>
+</div>
+</div>
+
+<!-- Filter -->
+<div id="filter" class="tab">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-palette text-purple-600"></i> Filters</h2>
+<div class="preview-container mb-4">
+<input type="file" id="filter-input" accept="image/*" onchange="act(event,'filter','loadFilter',this)" class="hidden">
+<label for="filter-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Image</p>
+</label>
+</div>
+<div id="filter-container" style="display:none">
+<div class="text-center mb-4"><canvas id="filter-canvas" class="mx-auto"></canvas></div>
+<div class="grid grid-cols-2 md:grid-cols-4 gap-3 mb-4">
+<button onclick="act(event,'filter','applyFilter',this,'none')" class="preset-btn active">Original</button>
+<button onclick="act(event,'filter','applyFilter',this,'grayscale')" class="preset-btn">Grayscale</button>
+<button onclick="act(event,'filter','applyFilter',this,'sepia')" class="preset-btn">Sepia</button>
+<button onclick="act(event,'filter','applyFilter',this,'blur')" class="preset-btn">Blur</button>
+<button onclick="act(event,'filter','applyFilter',this,'brightness')" class="preset-btn">Bright</button>
+<button onclick="act(event,'filter','applyFilter',this,'contrast')" class="preset-btn">Contrast</button>
+<button onclick="act(event,'filter','applyFilter',this,'saturate')" class="preset-btn">Vibrant</button>
+<button onclick="act(event,'filter','applyFilter',this,'invert')" class="preset-btn">Invert</button>
+</div>
+<div class="flex gap-2">
+<button onclick="act(event,'filter','resetFilter')" class="flex-1 bg-gray-500 text-white px-6 py-3 rounded-lg"><i class="fas fa-undo mr-2"></i>Reset</button>
+<button onclick="act(event,'filter','downloadFilter')" class="flex-1 btn-primary text-white px-6 py-3 rounded-lg"><i class="fas fa-download mr-2"></i>Download</button>
+</div>
+</div>
+</div>
+
+<!-- PDF -->
+<div id="pdf" class="tab">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-file-pdf text-purple-600"></i> Images to PDF</h2>
+<form id="form-pdf" onsubmit="act(event,'pdf','handlePDF',event)">
+<div class="preview-container mb-4">
+<input type="file" id="pdf-input" name="files" accept="image/*" multiple required onchange="act(event,'pdf','handlePDFImages',this)" class="hidden">
+<label for="pdf-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Multiple Images</p>
+</label>
+</div>
+<div id="pdf-preview" class="grid grid-cols-2 md:grid-cols-4 gap-4 mb-4"></div>
+<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-file-pdf mr-2"></i>Create PDF</button>
+</form>
+<div id="pdf-result" class="mt-6"></div>
+</div>
+
+<!-- Signature -->
+<div id="signature" class="tab">
+<h2 class="text-2xl font-bold mb-4"><i class="fas fa-signature text-purple-600"></i> Signature Tool</h2>
+<form id="form-signature" onsubmit="act(event,'signature','handleSignature',event)">
+<div class="preview-container mb-4">
+<input type="file" id="signature-input" name="image" accept="image/*" required onchange="previewImage(this,'signature-preview')" class="hidden">
+<label for="signature-input" class="cursor-pointer inline-block">
+<i class="fas fa-cloud-upload-alt text-6xl text-gray-400"></i>
+<p class="text-lg font-medium mt-2">Upload Signature</p>
+</label>
+<div id="signature-preview"></div>
+</div>
+<div class="grid grid-cols-1 md:grid-cols-5 gap-4 mb-4">
+<div><label class="block text-sm font-medium mb-2">Width:</label>
+<input name="width" type="number" value="140" min="50" required class="w-full px-4 py-2 border rounded-lg"></div>
+<div><label class="block text-sm font-medium mb-2">Height:</label>
+<input name="height" type="number" value="60" min="30" required class="w-full px-4 py-2 border rounded-lg"></div>
+<div><label class="block text-sm font-medium mb-2">Max Size:</label>
+<select name="maxsize" class="w-full px-4 py-2 border rounded-lg">
+<option value="20">20 KB</option><option value="50" selected>50 KB</option><option value="100">100 KB</option></select></div>
+<div><label class="block text-sm font-medium mb-2">Clean Up:</label>
+<select name="clean" class="w-full px-4 py-2 border rounded-lg">
+<option value="1" selected>Whiten &amp; trim</option><option value="0">Off</option></select></div>
+<div><label class="block text-sm font-medium mb-2">Ink:</label>
+<select name="mode" class="w-full px-4 py-2 border rounded-lg">
+<option value="color" selected>Color</option><option value="gray">Grayscale</option><option value="bw">Black &amp; White</option></select></div>
+</div>
+<button type="submit" class="btn-primary text-white px-8 py-3 rounded-lg w-full"><i class="fas fa-magic mr-2"></i>Process Signature</button>
+</form>
+<div id="signature-result" class="mt-6"></div>
+</div>
+
+</div>
 
-function applyFilter(filter){
-document.querySelectorAll('#filter .preset-btn').forEach(b=>b.classList.remove('active'));
-event.target.classList.add('active');
-currentFilter=filter;
-drawFilter();
-}
+<!-- Footer -->
+<div class="mt-8 text-center text-sm text-gray-600">
+<p>© 2024 ImageMaster Pro • Perfect for Government Job Applications</p>
+</div>
 
-function drawFilter(){
-if(!filterImg||!filterCanvas)return;
-filterCtx.clearRect(0,0,filterCanvas.width,filterCanvas.height);
-const filters={'none':'none','grayscale':'grayscale(100%)','sepia':'sepia(100%)','blur':'blur(3px)','brightness':'brightness(1.3)','contrast':'contrast(1.3)','saturate':'saturate(1.5)','invert':'invert(100%)'};
-filterCtx.filter=filters[currentFilter]||'none';
-filterCtx.drawImage(filterImg,0,0);
-filterCtx.filter='none';
-}
+</div>
 
-function resetFilter(){
-currentFilter='none';
-document.querySelectorAll('#filter .preset-btn').forEach((b,i)=>{
-b.classList.remove('active');
-if(i===0)b.classList.add('active');
+<script>
+// Tab scripts load the first time their tab is shown
+const MODULES={{ modules|tojson }};
+const scripts={};
+function loadScript(src){
+if(!scripts[src])scripts[src]=new Promise((resolve,reject)=>{
+const s=document.createElement('script');
+s.src=src;s.onload=resolve;
+s.onerror=()=>{delete scripts[src];reject();};
+document.head.appendChild(s);
 });
-drawFilter();
+return scripts[src];
 }
-
-function downloadFilter(){
-if(!filterCanvas)return;
-downloadCanvas(filterCanvas,'filtered');
+function loadModule(id){
+return MODULES[id]?loadScript(MODULES[id]):Promise.resolve();
 }
 
-// PDF
-function handlePDFImages(input){
-const preview=document.getElementById('pdf-preview');
-pdfImages=Array.from(input.files);
-renderPDF();
-if(sortable)sortable.destroy();
-sortable=Sortable.create(preview,{
-animation:150,
-onEnd:function(evt){
-const moved=pdfImages.splice(evt.oldIndex,1)[0];
-pdfImages.splice(evt.newIndex,0,moved);
+// Tab handlers go through act(), which waits for the tab's script the first
+// time instead of throwing; submits are cancelled up front either way
+function act(e,id,name,...args){
+if(e.type==='submit')e.preventDefault();
+loadModule(id).then(()=>window[name](...args),()=>alert('Could not load this tool. Check your connection and try again.'));
 }
+
+function showTab(id){
+loadModule(id);
+document.querySelectorAll('.tab').forEach(t=>t.classList.remove('active'));
+document.querySelectorAll('.tab-button').forEach(b=>b.classList.remove('active'));
+document.getElementById(id).classList.add('active');
+event.target.classList.add('active');
+['passport-result','compress-result','pdf-result','signature-result'].forEach(r=>{
+const el=document.getElementById(r);if(el)el.innerHTML='';
 });
 }
 
-function renderPDF(){
-const preview=document.getElementById('pdf-preview');
-preview.innerHTML='';
-pdfImages.forEach((file,idx)=>{
+function previewImage(input,previewId){
+const preview=document.getElementById(previewId);
+if(input.files&&input.files[0]){
 const reader=new FileReader();
 reader.onload=function(e){
-const div=document.createElement('div');
-div.className='pdf-image-item';
-div.innerHTML=`<img src="${e.target.result}"><div class="remove-btn" onclick="removePDF(${idx})">×</div><p class="text-xs text-gray-600 mt-1 text-center">${idx+1}</p>`;
-preview.appendChild(div);
+const img=new Image();
+img.onload=function(){
+const size=(input.files[0].size/1024).toFixed(1);
+preview.innerHTML=`<img src="${e.target.result}" class="preview-image"><p class="text-sm text-gray-600 mt-2"><i class="fas fa-info-circle"></i> ${img.width}×${img.height}px • ${size}KB</p>`;
 };
-reader.readAsDataURL(file);
-});
+img.src=e.target.result;
+};
+reader.readAsDataURL(input.files[0]);
 }
-
-function removePDF(idx){
-pdfImages.splice(idx,1);
-renderPDF();
-if(sortable)sortable.destroy();
-if(pdfImages.length>0){
-sortable=Sortable.create(document.getElementById('pdf-preview'),{
-animation:150,
-onEnd:function(evt){
-const moved=pdfImages.splice(evt.oldIndex,1)[0];
-pdfImages.splice(evt.newIndex,0,moved);
 }
-});
+
+// Full-resolution exports come from the server; the canvas is the fallback
+async function downloadServer(path,inputId,params,name,fallback){
+const file=document.getElementById(inputId).files[0];
+if(!file){fallback();return;}
+const formData=new FormData();
+formData.append('image',file);
+Object.entries(params).forEach(([k,v])=>formData.append(k,v));
+try{
+const response=await fetch(path,{method:'POST',body:formData});
+if(!response.ok)throw new Error(await response.text());
+const blob=await response.blob();
+const url=URL.createObjectURL(blob);
+downloadFile(url,name+'.'+({'image/png':'png'}[blob.type]||'jpg'));
+setTimeout(()=>URL.revokeObjectURL(url),1000);
+}catch(err){
+fallback();
 }
 }
 
@@ -730,92 +2677,6 @@ URL.revokeObjectURL(url);
 },'image/png');
 }
 
-// Server handlers
-async function handlePassport(e){
-e.preventDefault();
-const form=e.target;
-const formData=new FormData(form);
-const resultDiv=document.getElementById('passport-result');
-resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Creating passport photo...</p>';
-try{
-const response=await fetch('/passport',{method:'POST',body:formData});
-if(response.ok){
-const blob=await response.blob();
-const url=URL.createObjectURL(blob);
-const size=(blob.size/1024).toFixed(1);
-resultDiv.innerHTML=`<div class="bg-green-50 border border-green-200 rounded-lg p-4 mb-4"><i class="fas fa-check-circle text-green-600"></i> <span class="font-bold text-green-700">Success!</span> ${size}KB</div><div class="text-center"><img src="${url}" class="preview-image mx-auto mb-4"><button onclick="downloadFile('${url}','passport_photo.jpg')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download</button></div>`;
-}else{
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
-}
-}catch(err){
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
-}
-}
-
-async function handleCompress(e){
-e.preventDefault();
-const form=e.target;
-const formData=new FormData(form);
-const resultDiv=document.getElementById('compress-result');
-resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Compressing...</p>';
-try{
-const response=await fetch('/compress',{method:'POST',body:formData});
-if(response.ok){
-const blob=await response.blob();
-const url=URL.createObjectURL(blob);
-const size=(blob.size/1024).toFixed(1);
-resultDiv.innerHTML=`<div class="bg-green-50 border border-green-200 rounded-lg p-4 mb-4"><i class="fas fa-check-circle text-green-600"></i> <span class="font-bold text-green-700">Success!</span> ${size}KB</div><div class="text-center"><img src="${url}" class="preview-image mx-auto mb-4"><button onclick="downloadFile('${url}','compressed.jpg')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download</button></div>`;
-}else{
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
-}
-}catch(err){
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
-}
-}
-
-async function handlePDF(e){
-e.preventDefault();
-const form=e.target;
-const formData=new FormData(form);
-formData.delete('files');
-pdfImages.forEach(file=>formData.append('files',file));
-const resultDiv=document.getElementById('pdf-result');
-resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Creating PDF...</p>';
-try{
-const response=await fetch('/to_pdf',{method:'POST',body:formData});
-if(response.ok){
-const blob=await response.blob();
-const url=URL.createObjectURL(blob);
-resultDiv.innerHTML=`<div class="text-center bg-gradient-to-r from-purple-50 to-blue-50 p-8 rounded-lg"><i class="fas fa-file-pdf text-6xl text-red-500 mb-4"></i><h3 class="font-bold text-xl mb-2">PDF Created!</h3><p class="text-gray-600 mb-4">${pdfImages.length} images</p><button onclick="downloadFile('${url}','document.pdf')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download PDF</button></div>`;
-}else{
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
-}
-}catch(err){
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
-}
-}
-
-async function handleSignature(e){
-e.preventDefault();
-const form=e.target;
-const formData=new FormData(form);
-const resultDiv=document.getElementById('signature-result');
-resultDiv.innerHTML='<div class="loader"></div><p class="text-center mt-2">Processing...</p>';
-try{
-const response=await fetch('/signature',{method:'POST',body:formData});
-if(response.ok){
-const blob=await response.blob();
-const url=URL.createObjectURL(blob);
-const size=(blob.size/1024).toFixed(1);
-resultDiv.innerHTML=`<div class="bg-green-50 border border-green-200 rounded-lg p-4 mb-4"><i class="fas fa-check-circle text-green-600"></i> <span class="font-bold text-green-700">Success!</span> ${size}KB</div><div class="text-center"><div class="bg-white p-4 inline-block mb-4"><img src="${url}" class="preview-image mx-auto" style="max-height:150px"></div><br><button onclick="downloadFile('${url}','signature.jpg')" class="bg-green-500 text-white px-8 py-3 rounded-lg hover:bg-green-600"><i class="fas fa-download mr-2"></i>Download</button></div>`;
-}else{
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${await response.text()}</div>`;
-}
-}catch(err){
-resultDiv.innerHTML=`<div class="bg-red-50 border border-red-200 rounded-lg p-4 text-red-700"><i class="fas fa-exclamation-circle"></i> Error: ${err.message}</div>`;
-}
-}
-
 function downloadFile(url,filename){
 const a=document.createElement('a');
 a.href=url;
@@ -824,157 +2685,279 @@ document.body.appendChild(a);
 a.click();
 document.body.removeChild(a);
 }
+
+loadModule(document.querySelector('.tab.active').id);
 </script>
 </body>
 </html>
 """
 
+# Assets are served from memory with strong ETags, with gzip variants and,
+# when the brotli module is installed, brotli ones. Scripts and the
+# stylesheet live at content-hashed URLs and are cached for a year; the
+# shell is revalidated on every load.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class StaticAsset:
+    def __init__(self, body, mimetype):
+        self.body = body.encode()
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(self.body).hexdigest()[:20]
+        self.variants = {'gzip': gzip.compress(self.body, 9, mtime=0)}
+        if brotli:
+            self.variants['br'] = brotli.compress(self.body)
+
+    def response(self, cache_control):
+        encoding = next((e for e in ('br', 'gzip') if e in self.variants and request.accept_encodings[e]), None)
+        etag = f'{self.etag}-{encoding}' if encoding else self.etag
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.variants[encoding] if encoding else self.body, mimetype=self.mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+ASSETS = {}
+
+def add_asset(name, body, mimetype):
+    # Registers body under a content-hashed name and returns its URL
+    asset = StaticAsset(body, mimetype)
+    stem, ext = name.rsplit('.', 1)
+    name = f'{stem}.{asset.etag[:10]}.{ext}'
+    ASSETS[name] = asset
+    return f'/assets/{name}'
+
+with app.app_context():
+    INDEX_PAGE = StaticAsset(app.jinja_env.from_string(HTML).render(
+        stylesheet=add_asset('app.css', CSS, 'text/css'),
+        modules={tab: add_asset(f'{tab}.js', js, 'text/javascript') for tab, js in TAB_SCRIPTS.items()}), 'text/html')
+
 # Routes
+@app.before_request
+def start_request_metrics():
+    collect_timings()
+    if request.method == 'POST':
+        count('bytes_in', request.content_length or 0)
+        with timed('upload'):
+            request.files
+
+@app.after_request
+def add_server_timing(response):
+    timings = take_timings()
+    if SERVER_TIMING and timings:
+        totals = {}
+        for stage, seconds in timings:
+            totals[stage] = totals.get(stage, 0) + seconds
+        response.headers['Server-Timing'] = ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in totals.items())
+    return response
+
+@app.route('/metrics')
+def metrics():
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append(f'# HELP imagemaster_{name} {help}')
+        lines.append(f'# TYPE imagemaster_{name} {kind}')
+        for labels, value in samples:
+            lines.append(f'imagemaster_{name}{labels} {value}')
+    with _stats_lock:
+        counters = dict(stats)
+        stages = {stage: list(totals) for stage, totals in stage_totals.items()}
+    metric('stage_seconds', 'summary', 'Time spent per processing stage.',
+           [(f'_sum{{stage="{stage}"}}', f'{seconds:.6f}') for stage, (n, seconds) in sorted(stages.items())] +
+           [(f'_count{{stage="{stage}"}}', n) for stage, (n, seconds) in sorted(stages.items())])
+    metric('encodes_total', 'counter', 'Image encodes in any output format, including quality search iterations.', [('', counters['encodes'])])
+    metric('probe_encodes_total', 'counter', 'Downsampled probe encodes used for size prediction.', [('', counters['probe_encodes'])])
+    metric('quality_searches_total', 'counter', 'Size-targeted quality searches.', [('', counters['quality_searches'])])
+    metric('fast_path_results_total', 'counter', 'Results served without decoding, e.g. lossless JPEG edits.',
+           [('', counters['fast_paths'])])
+    metric('size_model_ratio', 'gauge', 'Learned actual/estimated size correction of the size model.', [('', f'{size_model.ratio:.4f}')])
+    metric('bytes_in_total', 'counter', 'Request body bytes received on POST routes.', [('', counters['bytes_in'])])
+    metric('uploads_rejected_total', 'counter', 'Uploads rejected from their header while streaming in.',
+           [('', counters['uploads_rejected'])])
+    metric('bytes_out_total', 'counter', 'Result bytes sent.', [('', counters['bytes_out'])])
+    metric('result_cache_requests_total', 'counter', 'Result cache lookups.',
+           [('{result="hit"}', result_cache.hits), ('{result="miss"}', result_cache.misses)])
+    metric('result_cache_bytes', 'gauge', 'Bytes held in the in-memory result cache.', [('', result_cache.size)])
+    with admission.cond:
+        in_use, waiting, rejected = admission.in_use, len(admission.queue), admission.rejected
+    metric('admission_budget_bytes', 'gauge', 'Estimated decode memory the admission controller allows at once.',
+           [('', admission.budget)])
+    metric('admission_in_use_bytes', 'gauge', 'Estimated decode memory of admitted requests.', [('', in_use)])
+    metric('admission_queue_depth', 'gauge', 'Requests waiting for admission; wait time is stage_seconds{stage="admission"}.',
+           [('', waiting)])
+    metric('admission_rejected_total', 'counter', 'Requests turned away with 503 by admission control.', [('', rejected)])
+    metric('jobs', 'gauge', 'Jobs currently tracked, by status.',
+           [(f'{{status="{status}"}}', n) for status, n in job_queue.status_counts().items()])
+    metric('job_result_bytes', 'gauge', 'Bytes of finished job results waiting to be fetched.',
+           [('', job_queue.result_bytes)])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
-    return render_template_string(HTML)
+    return INDEX_PAGE.response('no-cache')
+
+@app.route('/assets/<name>')
+def asset(name):
+    asset = ASSETS.get(name)
+    if asset is None: return "Not found", 404
+    return asset.response('public, max-age=31536000, immutable')
 
 @app.route('/passport', methods=['POST'])
+@admitted
 def passport():
     try:
-        f = request.files.get('image')
-        if not f: return "No file", 400
-        if not allowed_filename(f.filename): return "Invalid type", 400
-        if not pil_open_validate(f.stream): return "Invalid image", 400
-        
-        width = int(request.form.get('width', 200))
-        height = int(request.form.get('height', 230))
-        maxsize = int(request.form.get('maxsize', 100)) * 1024
-        
-        f.stream.seek(0)
-        img = Image.open(f.stream)
-        img = ImageOps.exif_transpose(img)
-        img = img.resize((width, height), Image.LANCZOS)
-        img = img.convert('RGB')
-        
-        quality = 95
-        while quality > 10:
-            out = io.BytesIO()
-            img.save(out, format='JPEG', quality=quality, optimize=True)
-            if out.tell() <= maxsize:
-                break
-            quality -= 5
-        
-        out.seek(0)
-        tmp = save_temp_bytes(out.read(), '.jpg')
-        return send_file(tmp, as_attachment=True, download_name='passport_photo.jpg')
+        return single_route('passport')
     except Exception as e:
         traceback.print_exc()
         return f"Error: {str(e)}", 500
 
 @app.route('/compress', methods=['POST'])
+@admitted
 def compress():
     try:
-        f = request.files.get('image')
-        if not f: return "No file", 400
-        if not allowed_filename(f.filename): return "Invalid type", 400
-        if not pil_open_validate(f.stream): return "Invalid image", 400
-        
-        targetsize = int(request.form.get('targetsize', 50)) * 1024
-        
-        f.stream.seek(0)
-        img = Image.open(f.stream)
-        img = ImageOps.exif_transpose(img)
-        img = img.convert('RGB')
-        
-        quality = 95
-        while quality > 10:
-            out = io.BytesIO()
-            img.save(out, format='JPEG', quality=quality, optimize=True)
-            if out.tell() <= targetsize:
-                break
-            quality -= 5
-        
-        out.seek(0)
-        tmp = save_temp_bytes(out.read(), '.jpg')
-        return send_file(tmp, as_attachment=True, download_name='compressed.jpg')
+        return single_route('compress')
     except Exception as e:
         traceback.print_exc()
         return f"Error: {str(e)}", 500
 
 @app.route('/to_pdf', methods=['POST'])
+@admitted
 def to_pdf():
     try:
         files = request.files.getlist('files')
         if not files: return "No files", 400
+        uploads = [f.stream.read() for f in files if upload_error(f) is None]
+        try:
+            params = pdf_params(request.form)
+            check_pdf_maxsize(uploads, *params)
+        except ValueError as e:
+            return f"Invalid parameters: {e}", 400
         
-        imgs = []
-        for f in files:
-            if not allowed_filename(f.filename): continue
-            if not pil_open_validate(f.stream): continue
-            f.stream.seek(0)
-            img = Image.open(f.stream)
-            img = ImageOps.exif_transpose(img)
-            if img.mode in ('RGBA','LA','P'):
-                bg = Image.new('RGB', img.size, (255,255,255))
-                if img.mode == 'RGBA':
-                    bg.paste(img, mask=img.split()[-1])
-                else:
-                    bg.paste(img)
-                img = bg
-            else:
-                img = img.convert('RGB')
-            imgs.append(img)
-        
-        if not imgs: return "No valid images", 400
-        
-        out = io.BytesIO()
-        imgs[0].save(out, format='PDF', save_all=True, append_images=imgs[1:], quality=85)
-        out.seek(0)
-        tmp = save_temp_bytes(out.read(), '.pdf')
-        return send_file(tmp, as_attachment=True, download_name='document.pdf')
+        with timed('pdf'):
+            out = build_pdf(uploads, *params)
+        if out is None: return "No valid images", 400
+        return send_buffer(out, 'document.pdf')
     except Exception as e:
         traceback.print_exc()
         return f"Error: {str(e)}", 500
 
 @app.route('/signature', methods=['POST'])
+@admitted
 def signature():
     try:
-        f = request.files.get('image')
-        if not f: return "No file", 400
-        if not allowed_filename(f.filename): return "Invalid type", 400
-        if not pil_open_validate(f.stream): return "Invalid image", 400
-        
-        width = int(request.form.get('width', 140))
-        height = int(request.form.get('height', 60))
-        maxsize = int(request.form.get('maxsize', 50)) * 1024
+        return single_route('signature')
+    except Exception as e:
+        traceback.print_exc()
+        return f"Error: {str(e)}", 500
+
+@app.route('/crop', methods=['POST'])
+@admitted
+def crop():
+    try:
+        return single_route('crop')
+    except Exception as e:
+        traceback.print_exc()
+        return f"Error: {str(e)}", 500
+
+@app.route('/rotate', methods=['POST'])
+@admitted
+def rotate():
+    try:
+        return single_route('rotate')
+    except Exception as e:
+        traceback.print_exc()
+        return f"Error: {str(e)}", 500
+
+@app.route('/filter', methods=['POST'], endpoint='filter')
+@admitted
+def filter_image():
+    try:
+        return single_route('filter')
+    except Exception as e:
+        traceback.print_exc()
+        return f"Error: {str(e)}", 500
+
+@app.route('/batch', methods=['POST'])
+@admitted
+def batch():
+    try:
+        op = request.form.get('op', 'passport')
+        if op not in SINGLE_OPS: return "Invalid operation", 400
+        files = request.files.getlist('files')
+        if not files: return "No files", 400
         
-        f.stream.seek(0)
-        img = Image.open(f.stream)
-        img = ImageOps.exif_transpose(img)
+        forms = batch_forms(request.form, len(files))
+        if forms is None:
+            return "Invalid params: expected a JSON list of objects", 400
+        items = []
+        for i, (f, form) in enumerate(zip(files, forms)):
+            stem = f"{i + 1:03d}_{os.path.splitext(secure_filename(f.filename or ''))[0] or 'image'}"
+            error = upload_error(f, op)
+            items.append((stem, f.stream.read() if error is None else None, form, error))
         
-        if img.mode in ('RGBA', 'LA', 'P'):
-            bg = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'RGBA':
-                bg.paste(img, mask=img.split()[-1])
-            else:
-                bg.paste(img)
-            img = bg
+        return Response(stream_batch(op, items), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename={op}_batch.zip'})
+    except Exception as e:
+        traceback.print_exc()
+        return f"Error: {str(e)}", 500
+
+@app.route('/jobs/<op>', methods=['POST'])
+def submit_job(op):
+    try:
+        if op in SINGLE_OPS:
+            f = request.files.get('image')
+            if not f: return "No file", 400
+            if not allowed_filename(f.filename): return "Invalid type", 400
+            try:
+                SINGLE_OPS[op][0](request.form)
+            except ValueError as e:
+                return f"Invalid parameters: {e}", 400
+            job = job_queue.submit(run_admitted, request_cost(), single_job, op, f.stream.read(), request.form.to_dict())
+        elif op == 'to_pdf':
+            files = request.files.getlist('files')
+            if not files: return "No files", 400
+            uploads = [f.stream.read() for f in files if upload_error(f) is None]
+            try:
+                params = pdf_params(request.form)
+                check_pdf_maxsize(uploads, *params)
+            except ValueError as e:
+                return f"Invalid parameters: {e}", 400
+            job = job_queue.submit(run_admitted, request_cost(), pdf_job, uploads, params)
         else:
-            img = img.convert('RGB')
-        
-        img = img.resize((width, height), Image.LANCZOS)
-        
-        quality = 95
-        while quality > 10:
-            out = io.BytesIO()
-            img.save(out, format='JPEG', quality=quality, optimize=True)
-            if out.tell() <= maxsize:
-                break
-            quality -= 5
-        
-        out.seek(0)
-        tmp = save_temp_bytes(out.read(), '.jpg')
-        return send_file(tmp, as_attachment=True, download_name='signature.jpg')
+            return "Invalid operation", 404
+        if job is None:
+            return "Too many queued jobs", 429, {'Retry-After': '5'}
+        return jsonify(id=job.id, status=job.status, url=url_for('get_job', job_id=job.id)), 202
     except Exception as e:
         traceback.print_exc()
         return f"Error: {str(e)}", 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None: return "Unknown job", 404
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_MAX_WAIT)
+    except ValueError:
+        return "Invalid wait", 400
+    if wait > 0:
+        job.done.wait(wait)
+    if job.status == 'done':
+        result = job_queue.take(job)
+        if result is None: return "Unknown job", 404
+        data, name = result
+        return send_buffer(io.BytesIO(data), name)
+    if job.status == 'failed':
+        return jsonify(id=job.id, status=job.status, error=job.error), 422
+    return jsonify(id=job.id, status=job.status), 202
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print("\n" + "="*60)
@@ -0,0 +1,297 @@
+# bench.py – Throughput and latency benchmarks for the image endpoints
+#
+#   python bench.py                        in-process, results as JSON on stdout
+#   python bench.py --mode both -o out.json
+#   python bench.py --baseline old.json    also print the change against old.json
+#
+# Synthetic uploads are generated once per run from --seed, so two runs on
+# the same machine exercise identical inputs.
+import os, io, sys, json, time, random, argparse, platform, socket, subprocess, urllib.request, uuid
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFilter
+import PIL
+
+# Corpus generation
+def phone_photo(megapixels, rng, orientation=1):
+    w = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    h = w * 3 // 4
+    # Blurred noise over gradients compresses roughly like a camera photo
+    base = Image.effect_noise((w // 8, h // 8), 64).resize((w, h), Image.BICUBIC)
+    grad = Image.linear_gradient('L').resize((w, h))
+    img = Image.merge('RGB', (base, grad, Image.eval(grad, lambda v: 255 - v)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(w), rng.randrange(h)
+        r = rng.randrange(w // 20, w // 6)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    out = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    img.save(out, 'JPEG', quality=92, exif=exif)
+    return out.getvalue()
+
+def signature_png(rng, size=(1200, 500)):
+    img = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    points = [(x, size[1] // 2 + rng.randrange(-150, 150)) for x in range(60, size[0] - 60, 40)]
+    draw.line(points, fill=(20, 20, 110, 255), width=8, joint='curve')
+    out = io.BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+def palette_gif(rng, size=(800, 600)):
+    img = Image.open(io.BytesIO(phone_photo(0.5, rng))).resize(size).quantize(64)
+    out = io.BytesIO()
+    img.save(out, 'GIF')
+    return out.getvalue()
+
+def build_corpus(seed, pages):
+    rng = random.Random(seed)
+    return {
+        'jpeg_2mp': phone_photo(2, rng),
+        'jpeg_8mp': phone_photo(8, rng),
+        'jpeg_12mp_rotated': phone_photo(12, rng, orientation=6),
+        'png_alpha': signature_png(rng),
+        'gif_palette': palette_gif(rng),
+        'batch': [phone_photo(rng.choice((2, 5, 8)), rng) for _ in range(pages)],
+    }
+
+# name, path, corpus item, form fields
+SCENARIOS = [
+    ('passport_2mp', '/passport', 'jpeg_2mp', {'width': '200', 'height': '230', 'maxsize': '50'}),
+    ('passport_12mp', '/passport', 'jpeg_12mp_rotated', {'width': '300', 'height': '350', 'maxsize': '50'}),
+    ('compress_8mp', '/compress', 'jpeg_8mp', {'targetsize': '100'}),
+    ('compress_12mp_tight', '/compress', 'jpeg_12mp_rotated', {'targetsize': '30'}),
+    ('compress_gif', '/compress', 'gif_palette', {'targetsize': '50'}),
+    ('signature_png', '/signature', 'png_alpha', {'width': '140', 'height': '60', 'maxsize': '20'}),
+    ('signature_gif', '/signature', 'gif_palette', {'width': '140', 'height': '60', 'maxsize': '20'}),
+    ('to_pdf_batch', '/to_pdf', 'batch', {}),
+]
+
+def upload_fields(corpus, item):
+    data = corpus[item]
+    if isinstance(data, list):
+        return [('files', f'page{i}.jpg', d) for i, d in enumerate(data)]
+    ext = {'png_alpha': 'png', 'gif_palette': 'gif'}.get(item, 'jpg')
+    return [('image', f'{item}.{ext}', data)]
+
+# Measurement
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+def reset_peak_rss(pid='self'):
+    # Linux: writing 5 to clear_refs resets VmHWM
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_kb(pid='self'):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+def run_scenario(send, requests, concurrency):
+    latencies, errors, bytes_out = [], 0, 0
+
+    def one(_):
+        start = time.perf_counter()
+        status, size = send()
+        return time.perf_counter() - start, status, size
+
+    send()  # warm-up, not measured
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, status, size in pool.map(one, range(requests)):
+            latencies.append(latency)
+            bytes_out += size
+            errors += status != 200
+    wall = time.perf_counter() - start
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'rps': round(requests / wall, 2),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)),
+        'bytes_out_per_request': bytes_out // requests,
+    }
+
+def bench_inprocess(corpus, args):
+    os.environ.setdefault('RESULT_CACHE_MB', '0')
+    import app as app_module
+    client = app_module.app.test_client()
+    results = []
+    for name, path, item, form in selected(args):
+        fields = upload_fields(corpus, item)
+
+        def send():
+            data = dict(form)
+            for field, filename, content in fields:
+                data.setdefault(field, []).append((io.BytesIO(content), filename))
+            r = client.post(path, data=data, content_type='multipart/form-data')
+            return r.status_code, len(r.data)
+
+        reset_peak_rss()
+        before = app_module.stats['encodes']
+        result = run_scenario(send, args.requests, args.concurrency)
+        # The warm-up request is counted too
+        result['encodes_per_request'] = round((app_module.stats['encodes'] - before) / (args.requests + 1), 2)
+        result['peak_rss_kb'] = peak_rss_kb()
+        results.append(dict(name=name, mode='inprocess', **result))
+        log(results[-1])
+    return results
+
+def multipart(form, fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for key, value in form.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode())
+    for field, filename, content in fields:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def scrape_encodes(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=10) as r:
+        for line in r.read().decode().splitlines():
+            if line.startswith('imagemaster_encodes_total '):
+                return int(line.split()[1])
+    return None
+
+def bench_gunicorn(corpus, args):
+    port = free_port()
+    env = dict(os.environ, RESULT_CACHE_MB=os.environ.get('RESULT_CACHE_MB', '0'))
+    cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+           '--workers', str(args.workers), '--threads', str(args.threads), '--timeout', '300']
+    server = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.2)
+        results = []
+        for name, path, item, form in selected(args):
+            body, content_type = multipart(form, upload_fields(corpus, item))
+
+            def send():
+                req = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=body,
+                                             headers={'Content-Type': content_type})
+                try:
+                    with urllib.request.urlopen(req, timeout=300) as r:
+                        return r.status, len(r.read())
+                except urllib.error.HTTPError as e:
+                    return e.code, len(e.read())
+
+            workers = child_pids(server.pid)
+            for pid in workers:
+                reset_peak_rss(pid)
+            before = scrape_encodes(port)
+            result = run_scenario(send, args.requests, args.concurrency)
+            # Counters are per worker process, so only exact with one worker
+            after = scrape_encodes(port) if args.workers == 1 else None
+            result['encodes_per_request'] = round((after - before) / (args.requests + 1), 2) if after is not None else None
+            rss = [peak_rss_kb(pid) for pid in workers]
+            result['peak_rss_kb'] = max((r for r in rss if r), default=None)
+            results.append(dict(name=name, mode='gunicorn', **result))
+            log(results[-1])
+        return results
+    finally:
+        server.terminate()
+        server.wait(10)
+
+def selected(args):
+    return [s for s in SCENARIOS if not args.only or s[0] in args.only]
+
+def log(result):
+    print(f"{result['mode']:>9} {result['name']:<22} p50 {result['p50_ms']:>8} ms  "
+          f"p95 {result['p95_ms']:>8} ms  {result['rps']:>7} req/s", file=sys.stderr)
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['mode'], r['name']): r for r in json.load(f)['results']}
+    print('\nchange against ' + baseline_path, file=sys.stderr)
+    for r in results:
+        old = baseline.get((r['mode'], r['name']))
+        if not old:
+            continue
+        change = lambda key: f"{(r[key] / old[key] - 1) * 100:+.1f}%" if old.get(key) and r.get(key) is not None else 'n/a'
+        print(f"{r['mode']:>9} {r['name']:<22} p50 {change('p50_ms'):>8}  p95 {change('p95_ms'):>8}  "
+              f"rps {change('rps'):>8}  rss {change('peak_rss_kb'):>8}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image endpoints.')
+    parser.add_argument('--mode', choices=('inprocess', 'gunicorn', 'both'), default='inprocess')
+    parser.add_argument('--requests', type=int, default=20, help='measured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--pages', type=int, default=10, help='pages in the /to_pdf batch')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='scenario names to run')
+    parser.add_argument('-o', '--output', help='write JSON here instead of stdout')
+    parser.add_argument('--baseline', help='earlier JSON output to compare against')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.seed, args.pages)
+    results = []
+    if args.mode in ('inprocess', 'both'):
+        results += bench_inprocess(corpus, args)
+    if args.mode in ('gunicorn', 'both'):
+        results += bench_gunicorn(corpus, args)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == '__main__':
+    main()